@@ -0,0 +1,97 @@
+"""Runtime of the dtw clustering, and agreement of its clusters with the unconstrained clustering.
+
+Also compares a warm-started daily update, from the clustering of the day before, with a full clustering.
+
+Uses the real data of the project directory, or synthetic data when a number of days and areas is given.
+
+Usage: python benchmarks/bench_clustering.py [n_days n_areas]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from synthetic import PROJECT_DIR, make_log_pivot_regs
+
+# Options compared with the unconstrained clustering
+configs = {
+    "sakoe_chiba r=28": {"global_constraint": "sakoe_chiba", "sakoe_chiba_radius": 28},
+    "itakura slope=2": {"global_constraint": "itakura", "itakura_max_slope": 2.0},
+    "paa 7": {"paa_window": 7},
+    "paa 7 + sakoe_chiba r=28": {"paa_window": 7, "global_constraint": "sakoe_chiba", "sakoe_chiba_radius": 28},
+    "paa 14 + sakoe_chiba r=28": {"paa_window": 14, "global_constraint": "sakoe_chiba", "sakoe_chiba_radius": 28},
+}
+
+
+def get_real_log_pivot_regs():
+    """Returns the transformed values of all the regions, from the project data."""
+
+    from constants import CSV_URL
+    import manage_app
+    import manage_input
+
+    os.chdir(PROJECT_DIR)
+    cov_df = manage_input.get_df(CSV_URL, download=False)
+    pop = manage_input.get_pop()
+    _, log_pivot_regs = manage_app.get_all_raw_log_data(cov_df, pop)
+
+    return log_pivot_regs.dropna()
+
+
+def get_region_labels(cluster_labels):
+    """Returns the cluster index of each region, from the lists of region names."""
+
+    return {region: c for c, regions in enumerate(cluster_labels) for region in regions}
+
+
+def time_clustering(log_pivot_regs, **options):
+    """Returns the cluster of each region and the seconds spent clustering."""
+
+    import timeseries_funcs
+
+    t0 = time.perf_counter()
+    _, cluster_labels, _ = timeseries_funcs.get_clusters(log_pivot_regs, **options)
+    return get_region_labels(cluster_labels), time.perf_counter() - t0
+
+
+def main(n_days=None, n_areas=None):
+    """Prints runtime and adjusted Rand index against the unconstrained clustering.
+
+    Args:
+        n_days (int): days of synthetic data, the real data if None
+        n_areas (int): areas of synthetic data
+    """
+
+    from sklearn.metrics import adjusted_rand_score
+
+    if n_days is None:
+        log_pivot_regs = get_real_log_pivot_regs()
+    else:
+        log_pivot_regs = make_log_pivot_regs(n_days, n_areas)
+    print(f"{log_pivot_regs.shape[0]} days, {log_pivot_regs.shape[1]} areas")
+
+    base_labels, base_time = time_clustering(log_pivot_regs, global_constraint=None, paa_window=None)
+    print(f"{'unconstrained':<28} {base_time:8.2f} s")
+
+    # Agreement of two unconstrained runs, as a reference
+    regions = sorted(base_labels)
+    seed_labels, seed_time = time_clustering(log_pivot_regs, global_constraint=None, paa_window=None, random_state=0)
+    agreement = adjusted_rand_score([base_labels[r] for r in regions], [seed_labels[r] for r in regions])
+    print(f"{'unconstrained, other seed':<28} {seed_time:8.2f} s  {base_time / seed_time:6.1f}x  ARI {agreement:5.2f}")
+
+    for name, options in configs.items():
+        labels, elapsed = time_clustering(log_pivot_regs, **options)
+        agreement = adjusted_rand_score([base_labels[r] for r in regions], [labels[r] for r in regions])
+        print(f"{name:<28} {elapsed:8.2f} s  {base_time / elapsed:6.1f}x  ARI {agreement:5.2f}")
+
+    # Daily update: yesterday's clustering saved, then today's started from it
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        time_clustering(log_pivot_regs.iloc[:-1], warm_start=True)
+        labels, elapsed = time_clustering(log_pivot_regs, warm_start=True)
+    agreement = adjusted_rand_score([base_labels[r] for r in regions], [labels[r] for r in regions])
+    print(f"{'warm start, one more day':<28} {elapsed:8.2f} s  {base_time / elapsed:6.1f}x  ARI {agreement:5.2f}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
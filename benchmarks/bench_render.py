@@ -0,0 +1,86 @@
+"""Time of a plot render: a new figure for each plot against the reused plot template.
+
+Usage: python benchmarks/bench_render.py [n_renders]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from synthetic import make_log_pivot_regs, make_pivot_regs
+
+
+def render_new_figure(pivot_regs, log_pivot_regs, suptitle, filename):
+    """The plot as it was drawn before the template: a new figure and a tight layout for each render."""
+
+    import manage_output
+
+    with manage_output.new_figure(figsize=manage_output.plot_render_params["figsize"]) as fig:
+        ax1, ax2 = fig.subplots(2)
+        fig.suptitle(suptitle)
+
+        ax1.plot(pivot_regs)
+        ax1.legend(pivot_regs.columns.values, loc="upper left")
+        ax1.set_title("VALORI ASSOLUTI NUOVI CONTAGI")
+        ax1.grid(True)
+        ax2.plot(log_pivot_regs)
+        ax2.legend(log_pivot_regs.columns.values, loc="upper left")
+        ax2.set_title("\nVALORI TRASFORMATI (proporzionali agli abitanti, scala log)")
+        ax2.grid(True)
+        fig.autofmt_xdate(rotation=-45, ha="left")
+        fig.tight_layout()
+
+        manage_output.save_figure(fig, filename, manage_output.plot_render_params)
+
+
+def time_renders(render, n_renders, n_days=400, n_areas=3):
+    """Returns the mean time of a render, in seconds.
+
+    Args:
+        render (function): called with the raw values, transformed values, title and file name
+        n_renders (int): how many renders
+        n_days (int): days in the plotted data
+        n_areas (int): plotted areas
+
+    Returns:
+        float: seconds per render
+    """
+
+    pivot_regs = make_pivot_regs(n_days, n_areas)
+    log_pivot_regs = make_log_pivot_regs(n_days, n_areas)
+    render(pivot_regs, log_pivot_regs, "warm-up", "warm-up.png")
+
+    t0 = time.perf_counter()
+    for i in range(n_renders):
+        render(pivot_regs, log_pivot_regs, str(i), f"{i}.png")
+
+    return (time.perf_counter() - t0) / n_renders
+
+
+def main(n_renders=50):
+    """Runs the comparison in a temporary directory.
+
+    Args:
+        n_renders (int): renders for each code path
+    """
+
+    from constants import CSV_URL, IMAGES
+    import manage_output
+
+    def render_template(pivot_regs, log_pivot_regs, suptitle, filename):
+        manage_output.plot_graphs(pivot_regs, log_pivot_regs, suptitle, list(pivot_regs.columns), filename=filename)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        os.makedirs(IMAGES)
+        open(os.path.basename(CSV_URL), "w").close()  # Last update of the data, for the title
+
+        new_figure_time = time_renders(render_new_figure, n_renders)
+        template_time = time_renders(render_template, n_renders)
+
+    print(f"new figure: {new_figure_time * 1000:7.1f} ms/render")
+    print(f"template:   {template_time * 1000:7.1f} ms/render  ({new_figure_time / template_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,95 @@
+"""Time of the region sorts on synthetic data, against the former pandas greedy loops.
+
+The distance matrices are built once per data version, their time is printed apart.
+
+Usage: python benchmarks/bench_sort.py [n_days]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy.spatial import distance
+
+from synthetic import make_log_pivot_regs
+
+AREAS = [21, 107, 1000]
+SORTS = ["distance", "distance_initials", "correlation", "seriation", "pca", "kmeans"]
+
+
+def legacy_sort_by_distance(log_pivot_regs, initials=False):
+    """The greedy distance sort as it was: cdist, list.remove and .loc at every step."""
+
+    reg_list = list(log_pivot_regs.columns)
+    ordered_list = []
+    selected = reg_list[0]
+    while len(reg_list) > 1:
+        ordered_list.append(selected)
+        reg_list.remove(selected)
+        to_sort = log_pivot_regs.loc[:, reg_list]
+        already_sorted = log_pivot_regs.loc[:, ordered_list[:5] if initials else ordered_list[-5:]]
+        dists = distance.cdist(to_sort.T, already_sorted.T)
+        selected = to_sort.columns[np.linalg.norm(dists, axis=1).argmin()]
+    ordered_list.append(selected)
+
+    return ordered_list
+
+
+def legacy_sort_by_correlation(log_pivot_regs):
+    """The greedy correlation sort as it was: a Spearman matrix, list.remove and .loc at every step."""
+
+    corr_regs = log_pivot_regs.corr(method="spearman")
+    reg_list = list(corr_regs.columns)
+    ordered_list = []
+    selected = reg_list[0]
+    while len(reg_list) > 1:
+        ordered_list.append(selected)
+        reg_list.remove(selected)
+        selected = corr_regs.loc[reg_list, selected].idxmax()
+    ordered_list.append(selected)
+
+    return ordered_list
+
+
+def timed(func, *args, **kwargs):
+    """Returns the result of the call and the seconds it took."""
+
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def main(n_days=400):
+    """Prints the time of each sort, in milliseconds, for each number of areas."""
+
+    os.chdir(tempfile.mkdtemp())  # The distance store is written in the working directory
+    import distances
+    import manage_output
+
+    legacy = {
+        "distance": legacy_sort_by_distance,
+        "distance_initials": lambda df: legacy_sort_by_distance(df, initials=True),
+        "correlation": legacy_sort_by_correlation,
+    }
+
+    print(f"{'areas':>6} {'sort':<20} {'new ms':>10} {'legacy ms':>10} {'same order':>11}")
+    for n_areas in AREAS:
+        log_pivot_regs = make_log_pivot_regs(n_days, n_areas)
+
+        for metric in ("euclidean", "spearman"):
+            _, elapsed = timed(distances.get_distances, log_pivot_regs, metric)
+            print(f"{n_areas:>6} {metric + ' matrix':<20} {elapsed * 1000:>10.1f}")
+
+        for how in SORTS:
+            ordered_list, elapsed = timed(manage_output.get_sort_function(how), log_pivot_regs)
+            if how in legacy:
+                legacy_list, legacy_elapsed = timed(legacy[how], log_pivot_regs)
+                same = list(ordered_list) == legacy_list
+                print(f"{n_areas:>6} {how:<20} {elapsed * 1000:>10.1f} {legacy_elapsed * 1000:>10.1f} {str(same):>11}")
+            else:
+                print(f"{n_areas:>6} {how:<20} {elapsed * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
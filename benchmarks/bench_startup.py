@@ -0,0 +1,81 @@
+"""Cold start of a web worker: import time of main, resident memory, plotting and clustering modules loaded.
+
+Each run is a new interpreter, importing main then serving a page whose plot is cached, on synthetic data.
+Neither the import nor the cached page should load the modules of HEAVY_MODULES.
+
+Usage: python benchmarks/bench_startup.py [n_runs]
+"""
+import json
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from run import prepare_work_dir, write_dataset
+from synthetic import PROJECT_DIR
+
+HEAVY_MODULES = ["matplotlib", "seaborn", "scipy", "sklearn", "tslearn", "numba", "sort_regions", "timeseries_funcs"]
+
+# Runs in the new interpreter, prints its measures as JSON
+WORKER = """
+import json, sys, time
+sys.path[:0] = [{project_dir!r}, {project_dir!r} + "/benchmarks"]
+from synthetic import get_rss
+heavy_modules = {heavy_modules!r}
+
+t0 = time.perf_counter()
+import main
+import_seconds = time.perf_counter() - t0
+import_rss = get_rss()
+import_modules = [m for m in heavy_modules if m in sys.modules]
+
+t0 = time.perf_counter()
+response = main.app.test_client().post("/", data={{"multi_regions": {regions!r}}})
+assert response.status_code == 200, response.status_code
+page_seconds = time.perf_counter() - t0
+
+print(json.dumps({{
+    "import_seconds": import_seconds,
+    "import_rss": import_rss,
+    "import_modules": import_modules,
+    "page_seconds": page_seconds,
+    "page_rss": get_rss(),
+    "page_modules": [m for m in heavy_modules if m in sys.modules],
+}}))
+"""
+
+
+def main(n_runs=5):
+    """Prints the median import and cached page times, the largest resident memory, the heavy modules loaded.
+
+    Args:
+        n_runs (int): interpreters started
+    """
+
+    import manage_app
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        prepare_work_dir(work_dir)
+        data = write_dataset(1000, 21)
+        regions = data["regions"]
+        manage_app.compare_regions(regions, data["pop"], download=False)  # The plot is cached for the workers
+
+        worker = WORKER.format(project_dir=PROJECT_DIR, heavy_modules=HEAVY_MODULES, regions=regions)
+        runs = []
+        for _ in range(n_runs):
+            output = subprocess.run(
+                [sys.executable, "-c", worker], cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                universal_newlines=True, check=True
+            ).stdout
+            runs.append(json.loads(output.splitlines()[-1]))
+
+    for stage in ("import", "page"):
+        seconds = np.median([run[f"{stage}_seconds"] for run in runs])
+        rss = max(run[f"{stage}_rss"] for run in runs)
+        modules = sorted({m for run in runs for m in run[f"{stage}_modules"]})
+        print(f"{stage:<7} {seconds * 1000:8.1f} ms  rss {rss / 2 ** 20:7.1f} MiB  heavy modules: {modules or 'none'}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,413 @@
+"""Benchmark suite of the data and rendering paths, on synthetic data of any number of days and areas.
+
+Each case is timed on every size of the grid, after a setup that empties the caches it must not use.
+Results are saved as JSON, one file per commit, and two files can be compared to find regressions.
+The largest default size (10000 days of 1000 areas) needs about 6 GB of memory.
+
+Usage:
+    python benchmarks/run.py [--days 1000,10000] [--areas 21,107,1000] [--repeat 3] [--cases get_df,sort] [--output FILE]
+    python benchmarks/run.py --compare OLD.json NEW.json [--threshold 1.2]
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from synthetic import PROJECT_DIR, get_area_names, make_cov_df
+
+RESULTS_DIR = os.path.join(PROJECT_DIR, "benchmarks", "results")
+CLUSTERS_MAX_CELLS = 21 * 1000  # The dtw clustering is quadratic in days and areas: larger sizes are skipped
+PLOTTED_AREAS = 3
+
+# name: (function returning the call to time, largest days * areas, None for any size)
+cases = {}
+
+
+def case(name, max_cells=None):
+    """Registers a benchmark case.
+
+    The function receives the dataset, prepares the caches and returns the call to time.
+
+    Args:
+        name (str): name of the case in the results
+        max_cells (int): largest days * areas the case is run on, None for any size
+    """
+
+    def register(func):
+        cases[name] = (func, max_cells)
+        return func
+
+    return register
+
+
+def remove_files(*patterns):
+    """Deletes the files matching the patterns, in the working directory."""
+
+    for pattern in patterns:
+        for file_name in glob.glob(pattern):
+            os.remove(file_name)
+
+
+def clear_caches():
+    """Empties the in-memory and on-disk caches of the app."""
+
+    from constants import CLUSTERS_STATE, DISTANCE_STORE, TRANSFORMED_STORE
+    import distances
+    import manage_app
+    import manage_input
+
+    manage_input._df_cache.clear()
+    manage_app._all_regions_cache.clear()
+    distances._store_cache.clear()
+    remove_files(TRANSFORMED_STORE, CLUSTERS_STATE, DISTANCE_STORE)
+
+
+def prepare_work_dir(work_dir):
+    """Makes a working directory the app can run in: templates, images directory, a published artifacts version.
+
+    Args:
+        work_dir (str): an empty directory, the working directory afterwards
+    """
+
+    from constants import IMAGES
+    import image_store
+
+    os.chdir(work_dir)
+    for template in glob.glob(os.path.join(PROJECT_DIR, "*.html")) + glob.glob(os.path.join(PROJECT_DIR, "*.css")):
+        shutil.copy(template, work_dir)
+    os.makedirs(IMAGES)
+    image_store.publish_artifacts(image_store.new_artifacts_dir())  # The pages link the heatmaps only
+
+
+def write_dataset(n_days, n_areas):
+    """Writes the data, population and density files of a synthetic dataset in the working directory.
+
+    Args:
+        n_days (int): how many days
+        n_areas (int): how many areas, the benchmark region among them
+
+    Returns:
+        dict: sizes, raw data, population, all-areas raw and transformed values
+    """
+
+    from constants import CSV_URL, DENSITY_CSV, GRANULARITIES, POPULATION_CSV, REGION
+    import manage_app
+    import manage_input
+
+    names = sorted([GRANULARITIES[REGION]["bench_area"]] + get_area_names(n_areas - 1))
+    rng = np.random.RandomState(0)
+    pd.Series(rng.randint(10 ** 5, 10 ** 7, n_areas), index=names).to_frame("Population").to_csv(POPULATION_CSV)
+    pd.Series(rng.randint(30, 500, n_areas), index=names).to_frame("Density").to_csv(DENSITY_CSV)
+
+    make_cov_df(n_days, n_areas, names).to_csv(os.path.basename(CSV_URL), index=False)
+    clear_caches()
+    remove_files(manage_input.get_snapshot_name(os.path.basename(CSV_URL)))
+
+    cov_df = manage_input.get_df(CSV_URL, download=False)
+    pop = manage_input.get_pop()
+    pivot_regs, log_pivot_regs = manage_app.get_all_raw_log_data(cov_df, pop)
+
+    data = {
+        "n_days": n_days,
+        "n_areas": n_areas,
+        "cov_df": cov_df,
+        "pop": pop,
+        "regions": names[:PLOTTED_AREAS],
+        "pivot_regs": pivot_regs.copy(),  # Not views of the cached arrays, that the cold cases free
+        "log_pivot_regs": log_pivot_regs.dropna().copy(),
+    }
+
+    return data
+
+
+@case("get_df csv")
+def bench_get_df_csv(data):
+    from constants import CSV_URL
+    import manage_input
+
+    manage_input._df_cache.clear()
+    remove_files(manage_input.get_snapshot_name(os.path.basename(CSV_URL)))
+
+    return lambda: manage_input.get_df(CSV_URL, download=False)
+
+
+@case("get_df snapshot")
+def bench_get_df_snapshot(data):
+    from constants import CSV_URL
+    import manage_input
+
+    manage_input.get_df(CSV_URL, download=False)  # Writes the snapshot
+    manage_input._df_cache.clear()
+
+    return lambda: manage_input.get_df(CSV_URL, download=False)
+
+
+@case("get_raw_log_data cold")
+def bench_get_raw_log_data_cold(data):
+    from constants import TRANSFORMED_STORE
+    import manage_app
+
+    manage_app._all_regions_cache.clear()
+    remove_files(TRANSFORMED_STORE)
+
+    return lambda: manage_app.get_raw_log_data(data["cov_df"], data["regions"], data["pop"])
+
+
+@case("get_raw_log_data warm")
+def bench_get_raw_log_data_warm(data):
+    import manage_app
+
+    manage_app.get_raw_log_data(data["cov_df"], data["regions"], data["pop"])
+
+    return lambda: manage_app.get_raw_log_data(data["cov_df"], data["regions"], data["pop"])
+
+
+@case("normalize_smooth")
+def bench_normalize_smooth(data):
+    from constants import GRANULARITIES, REGION
+    import manage_app
+
+    bench_area = GRANULARITIES[REGION]["bench_area"]
+
+    return lambda: manage_app.normalize_smooth(data["pivot_regs"], data["pop"], bench_area)
+
+
+def add_sort_cases():
+    """Registers one case for each sort of the heatmaps, distance matrices included."""
+
+    import manage_output
+
+    def bench_sort(how):
+        def bench(data):
+            from constants import DISTANCE_STORE
+            import distances
+
+            distances._store_cache.clear()
+            remove_files(DISTANCE_STORE)
+
+            sort_function = manage_output.get_sort_function(how)
+
+            return lambda: sort_function(data["log_pivot_regs"])
+
+        return bench
+
+    for how in manage_output.sort_functions:
+        case(f"sort {how}")(bench_sort(how))
+
+
+@case("get_clusters", max_cells=CLUSTERS_MAX_CELLS)
+def bench_get_clusters(data):
+    from constants import CLUSTERS_STATE
+    import timeseries_funcs
+
+    remove_files(CLUSTERS_STATE)
+
+    return lambda: timeseries_funcs.get_clusters(data["log_pivot_regs"], n_clusters=3, warm_start=True)
+
+
+@case("plot_graphs")
+def bench_plot_graphs(data):
+    import manage_output
+
+    pivot_regs = data["pivot_regs"][data["regions"]]
+    log_pivot_regs = data["log_pivot_regs"][data["regions"]]
+
+    return lambda: manage_output.plot_graphs(
+        pivot_regs, log_pivot_regs, " - ".join(data["regions"]), data["regions"], filename="plot_graphs.png"
+    )
+
+
+@case("build_heatmap")
+def bench_build_heatmap(data):
+    from constants import DISTANCE_STORE
+    import distances
+    import manage_output
+
+    distances._store_cache.clear()
+    remove_files(DISTANCE_STORE)
+
+    return lambda: manage_output.build_heatmap(data["log_pivot_regs"], "pca", directory=".")
+
+
+@case("compare_region_cov new plot")
+def bench_request_new_plot(data):
+    from constants import IMAGES
+    import main
+
+    remove_files(os.path.join(IMAGES, "*.png"))
+    client = main.app.test_client()
+
+    return lambda: check_response(client.post("/", data={"multi_regions": data["regions"]}))
+
+
+@case("compare_region_cov cached plot")
+def bench_request_cached_plot(data):
+    import main
+
+    client = main.app.test_client()
+    check_response(client.post("/", data={"multi_regions": data["regions"]}))
+
+    return lambda: check_response(client.post("/", data={"multi_regions": data["regions"]}))
+
+
+def check_response(response):
+    """Fails the case if the request failed."""
+
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+
+
+def get_commit():
+    """Returns the current commit of the project, with a + if the tree has changes."""
+
+    def git(*args):
+        return subprocess.run(
+            ["git"] + list(args), cwd=PROJECT_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        ).stdout.strip()
+
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    if git("status", "--porcelain", "--untracked-files=no"):
+        commit += "+"
+
+    return commit
+
+
+def run_suite(days, areas, repeat, selected=None):
+    """Runs the cases on each size of the grid, in a temporary directory.
+
+    Args:
+        days (list of int): numbers of days
+        areas (list of int): numbers of areas
+        repeat (int): timed calls of each case
+        selected (list of str): prefixes of the cases to run, all of them if None
+
+    Returns:
+        list of dict: one result per case and size
+    """
+
+    add_sort_cases()
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        prepare_work_dir(work_dir)
+
+        for n_days in days:
+            for n_areas in areas:
+                t0 = time.perf_counter()
+                data = write_dataset(n_days, n_areas)
+                print(f"dataset {n_days} days x {n_areas} areas: {time.perf_counter() - t0:.1f} s")
+
+                for name, (bench, max_cells) in cases.items():
+                    if selected and not any(name.startswith(prefix) for prefix in selected):
+                        continue
+                    result = {"case": name, "days": n_days, "areas": n_areas}
+                    if max_cells is not None and n_days * n_areas > max_cells:
+                        result["skipped"] = True
+                    else:
+                        seconds = []
+                        for _ in range(repeat):
+                            call = bench(data)
+                            t0 = time.perf_counter()
+                            call()
+                            seconds.append(time.perf_counter() - t0)
+                        result.update(seconds=seconds, min=min(seconds), median=float(np.median(seconds)))
+                        print(f"  {name:<32} {result['median'] * 1000:>10.1f} ms")
+                    results.append(result)
+
+    return results
+
+
+def compare(old_name, new_name, threshold):
+    """Prints the ratio of the median times of two runs.
+
+    Args:
+        old_name (str): results file of the reference commit
+        new_name (str): results file of the commit to check
+        threshold (float): ratio over which a case is a regression
+
+    Returns:
+        int: how many cases regressed
+    """
+
+    with open(old_name, "r") as f:
+        old = json.load(f)
+    with open(new_name, "r") as f:
+        new = json.load(f)
+
+    def get_key(result):
+        return result["case"], result["days"], result["areas"]
+
+    old_results = {get_key(result): result for result in old["results"] if not result.get("skipped")}
+
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'case':<32} {'days':>6} {'areas':>6} {'old ms':>10} {'new ms':>10} {'ratio':>7}")
+    regressions = 0
+    for result in new["results"]:
+        old_result = old_results.get(get_key(result))
+        if result.get("skipped") or old_result is None:
+            continue
+        ratio = result["median"] / old_result["median"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(
+            f"{result['case']:<32} {result['days']:>6} {result['areas']:>6} {old_result['median'] * 1000:>10.1f} "
+            f"{result['median'] * 1000:>10.1f} {ratio:>7.2f}{flag}"
+        )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", default="1000,10000", help="comma-separated numbers of days")
+    parser.add_argument("--areas", default="21,107,1000", help="comma-separated numbers of areas")
+    parser.add_argument("--repeat", type=int, default=3, help="timed calls of each case")
+    parser.add_argument("--cases", default="", help="comma-separated prefixes of the cases to run")
+    parser.add_argument("--output", help="results file, benchmarks/results/<commit>.json by default")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results files")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    commit = get_commit()
+    output = os.path.abspath(args.output or os.path.join(RESULTS_DIR, f"{commit}.json"))
+    results = run_suite(
+        [int(n) for n in args.days.split(",")],
+        [int(n) for n in args.areas.split(",")],
+        args.repeat,
+        [prefix for prefix in args.cases.split(",") if prefix],
+    )
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "results": results,
+            },
+            f,
+            indent=1,
+        )
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Renders many plots from a thread pool and reports the memory of the process.
+
+The resident memory must level off after the first batches: figures are not leaked.
+
+Usage: python benchmarks/stress_render.py [n_renders] [n_threads]
+"""
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+from synthetic import get_rss, make_log_pivot_regs, make_pivot_regs
+
+
+def main(n_renders=2000, n_threads=4, batch_size=200):
+    """Runs the stress test in a temporary directory.
+
+    Args:
+        n_renders (int): total number of plots
+        n_threads (int): threads rendering at the same time
+        batch_size (int): renders between two memory readings
+    """
+
+    from constants import CSV_URL, IMAGES
+    import manage_output
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        os.makedirs(IMAGES)
+        open(os.path.basename(CSV_URL), "w").close()  # Last update of the data, for the title
+
+        pivot_regs = make_pivot_regs(700, 3)
+        log_pivot_regs = make_log_pivot_regs(700, 3)
+
+        def render(i):
+            manage_output.plot_graphs(
+                pivot_regs, log_pivot_regs, suptitle=str(i), regions=list(pivot_regs.columns), filename=f"{i}.png"
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as pool:
+            for start in range(0, n_renders, batch_size):
+                t0 = time.perf_counter()
+                list(pool.map(render, range(start, min(start + batch_size, n_renders))))
+                elapsed = time.perf_counter() - t0
+                print(f"{start + batch_size:6d} renders  {elapsed / batch_size * 1000:7.1f} ms/render  "
+                      f"rss {get_rss() / 2 ** 20:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,104 @@
+"""Synthetic data for the benchmarks: same shapes as the real data, any number of days and areas."""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# The benchmarks import the app modules from the project directory
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from constants import DATA, DATA_METRICS, DENOMINAZIONE_REGIONE, SNAPSHOT_COLUMNS
+
+
+def get_area_names(n_areas):
+    """Returns area names, sorted like the pivoted data.
+
+    Args:
+        n_areas (int): how many areas
+
+    Returns:
+        list of str: area names
+    """
+
+    return [f"Area {i:04d}" for i in range(n_areas)]
+
+
+def make_pivot_regs(n_days, n_areas, seed=0):
+    """Builds daily new cases, one column per area.
+
+    Each area follows a random walk in log space, so the series have waves and trends.
+
+    Args:
+        n_days (int): how many days
+        n_areas (int): how many areas
+        seed (int): random seed
+
+    Returns:
+        pandas.DataFrame: (n.days * n.areas) positive raw values
+    """
+
+    rng = np.random.RandomState(seed)
+    log_values = 5 + np.cumsum(rng.normal(0, 0.05, size=(n_days, n_areas)), axis=0)
+    values = np.round(np.exp(log_values) * rng.uniform(0.5, 2, size=n_areas)) + 1
+    index = pd.date_range("2020-02-24 18:00:00", periods=n_days, freq="D", name="data")
+
+    return pd.DataFrame(values, index=index, columns=get_area_names(n_areas))
+
+
+def make_log_pivot_regs(n_days, n_areas, seed=0):
+    """Builds transformed values, one column per area, without NaN values.
+
+    Args:
+        n_days (int): how many days
+        n_areas (int): how many areas
+        seed (int): random seed
+
+    Returns:
+        pandas.DataFrame: (n.days * n.areas) log values
+    """
+
+    pivot_regs = make_pivot_regs(n_days, n_areas, seed)
+
+    return np.log2(pivot_regs.rolling(7, min_periods=1).mean())
+
+
+def make_cov_df(n_days, n_areas, names=None, seed=0):
+    """Builds vertical data like the regional csv file: one row per day and area, every value column.
+
+    Cumulative columns are the running sums of synthetic daily values.
+
+    Args:
+        n_days (int): how many days
+        n_areas (int): how many areas
+        names (list of str): area names, get_area_names if None
+        seed (int): random seed
+
+    Returns:
+        pandas.DataFrame: the data, sorted by day like the csv file
+    """
+
+    if names is None:
+        names = get_area_names(n_areas)
+
+    columns = {}
+    for i, column in enumerate(SNAPSHOT_COLUMNS):
+        pivot_regs = make_pivot_regs(n_days, n_areas, seed + i)
+        values = pivot_regs.values
+        if DATA_METRICS[column]["cumulative"]:
+            values = np.cumsum(values, axis=0)
+        columns[column] = values.ravel()
+    columns[DATA] = np.repeat(pivot_regs.index.values, n_areas)
+    columns[DENOMINAZIONE_REGIONE] = np.tile(names, n_days)
+
+    return pd.DataFrame(columns, columns=[DATA, DENOMINAZIONE_REGIONE] + SNAPSHOT_COLUMNS)
+
+
+def get_rss():
+    """Returns the resident memory of this process, in bytes (Linux only)."""
+
+    with open("/proc/self/statm", "r") as f:
+        resident_pages = int(f.read().split()[1])
+
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
@@ -1,19 +1,117 @@
 """ Constant values are grouped here for easy access """
+import os
 
 # Column names
 LOG_NUOVI_POSITIVI = "log_nuovi_positivi"
 NUOVI_POSITIVI = "nuovi_positivi"
+RICOVERATI_CON_SINTOMI = "ricoverati_con_sintomi"
+TERAPIA_INTENSIVA = "terapia_intensiva"
+INGRESSI_TERAPIA_INTENSIVA = "ingressi_terapia_intensiva"
+DECEDUTI = "deceduti"
+TAMPONI = "tamponi"
 DENOMINAZIONE_REGIONE = "denominazione_regione"
+DENOMINAZIONE_PROVINCIA = "denominazione_provincia"
+TOTALE_CASI = "totale_casi"
 CASI_DA_SOSPETTO_DIAGNOSTICO = "casi_da_sospetto_diagnostico"
+DATA = "data"
+
+# Value columns kept in the binary snapshot of the data file
+SNAPSHOT_COLUMNS = [NUOVI_POSITIVI, RICOVERATI_CON_SINTOMI, TERAPIA_INTENSIVA, INGRESSI_TERAPIA_INTENSIVA, DECEDUTI, TAMPONI]
+
+# Metrics the users can choose: label, whether the column is cumulative (differenced to daily values),
+# whether it is a stock (people present on the day: a zero is a real value, not backfilled as a missing report)
+DATA_METRICS = {
+    NUOVI_POSITIVI: {"label": "nuovi contagi", "cumulative": False, "stock": False},
+    RICOVERATI_CON_SINTOMI: {"label": "ricoverati con sintomi", "cumulative": False, "stock": True},
+    TERAPIA_INTENSIVA: {"label": "in terapia intensiva", "cumulative": False, "stock": True},
+    INGRESSI_TERAPIA_INTENSIVA: {"label": "ingressi in terapia intensiva", "cumulative": False, "stock": False},
+    DECEDUTI: {"label": "nuovi decessi", "cumulative": True, "stock": False},
+    TAMPONI: {"label": "nuovi tamponi", "cumulative": True, "stock": False},
+}
 
 # Other constants
 LOMBARDIA = "Lombardia"
+MILANO = "Milano"
+ROLLING_WINDOW = 7  # Days in the smoothing window
+CLUSTERS_INERTIA_TOLERANCE = 0.1  # Worsening of the warm-started clustering that triggers a full one
+DISTANCE_TAIL_DAYS = 60  # Last days kept with the distances: older days are not expected to change
+DOWNLOAD_CHUNK_SIZE = 1 << 16  # Bytes
+DOWNLOAD_TIMEOUT = 60  # Seconds
+DATA_MAX_AGE = 3600  # Seconds the browser may reuse a /data response without revalidating
+
+RENDER_LOCK_STRIPES = 64  # Render locks shared by all image names
+ARTIFACTS_KEEP = 3  # Published versions kept, for pages served before a swap
+NIGHTLY_WORKERS = int(os.environ.get("COVCOMPARE_NIGHTLY_WORKERS", 0)) or None  # Processes, None for one per cpu
+
+# Budgets at province scale, checked by the scheduled operations and the page builds
+NIGHTLY_BUDGET = 900  # Seconds of the scheduled operations of one granularity
+PAGE_BUDGET = 2.0  # Seconds to build a page whose plot is not cached
+
+# Timing spans and cache counters, exposed on /metrics: off unless COVCOMPARE_METRICS is set
+METRICS_ENABLED = os.environ.get("COVCOMPARE_METRICS", "") not in ("", "0")
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)  # Seconds
+
+# On-demand profiling, of every page request and scheduled run if COVCOMPARE_PROFILE is set (cprofile, sampling
+# or all), of a single request if its profile argument is signed with COVCOMPARE_PROFILE_KEY
+PROFILE_MODE = os.environ.get("COVCOMPARE_PROFILE", "")
+PROFILE_KEY = os.environ.get("COVCOMPARE_PROFILE_KEY", "")
+PROFILE_DIR = os.environ.get("COVCOMPARE_PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.environ.get("COVCOMPARE_PROFILE_KEEP", 20))  # Profiled runs kept in PROFILE_DIR
+PROFILE_INTERVAL = 0.005  # Seconds between two samples of the sampling profiler
+
+# Budget of the plot images directory
+IMAGES_MAX_BYTES = int(os.environ.get("COVCOMPARE_IMAGES_MAX_BYTES", 512 * 2 ** 20))
+IMAGES_MAX_ENTRIES = int(os.environ.get("COVCOMPARE_IMAGES_MAX_ENTRIES", 5000))
 
 # URLs
-CSV_URL = "https://raw.githubusercontent.com/pcm-dpc/COVID-19/master/dati-regioni/dpc-covid19-ita-regioni.csv"
+DATA_BASE_URL = os.environ.get("COVCOMPARE_DATA_URL", "https://raw.githubusercontent.com/pcm-dpc/COVID-19/master")
+CSV_URL = f"{DATA_BASE_URL}/dati-regioni/dpc-covid19-ita-regioni.csv"
+PROVINCE_CSV_URL = f"{DATA_BASE_URL}/dati-province/dpc-covid19-ita-province.csv"
 IMAGES = "images"
 
 # Files
 DEFAULT_START = "default_start.txt"
 POPULATION_CSV = "population.csv"
 DENSITY_CSV = "density.csv"
+SNAPSHOT_EXT = ".npz"
+DOWNLOAD_HEADERS_EXT = ".headers.json"
+TRANSFORMED_STORE = "transformed_regions.npz"
+CLUSTERS_STATE = "clusters_state.npz"
+DISTANCE_STORE = "distances.npz"
+IMAGES_LOCK = ".lock"
+RENDER_LOCKS = ".locks"  # Directory of the render lock files, inside IMAGES
+RESET_LOCK = ".reset.lock"  # Lock file of the scheduled operations, inside IMAGES
+ARTIFACTS = "artifacts"  # Directory of the versions of the nightly images, inside IMAGES
+ARTIFACTS_CURRENT = "current"  # Link to the published version, inside ARTIFACTS
+
+# Data granularities
+REGION = "region"
+PROVINCE = "province"
+NIGHTLY_GRANULARITIES = os.environ.get("COVCOMPARE_GRANULARITIES", f"{REGION},{PROVINCE}").split(",")
+
+# Options of each granularity:
+# - csv_url: the data file
+# - area_column: names of the areas
+# - cumulative_column: cumulative cases, differenced to daily new cases; None if the file has daily new cases
+# - bench_area: the population reference, and the first area of the greedy sorts
+# - metrics: keys of DATA_METRICS in the data file
+# - dtw_params: options of the clustering, overriding timeseries_funcs.dtw_params
+# Population and density tables, stores and nightly images of a granularity have its prefix, regions have none
+GRANULARITIES = {
+    REGION: {
+        "csv_url": CSV_URL,
+        "area_column": DENOMINAZIONE_REGIONE,
+        "cumulative_column": None,
+        "bench_area": LOMBARDIA,
+        "metrics": SNAPSHOT_COLUMNS,
+        "dtw_params": {},
+    },
+    PROVINCE: {
+        "csv_url": PROVINCE_CSV_URL,
+        "area_column": DENOMINAZIONE_PROVINCIA,
+        "cumulative_column": TOTALE_CASI,
+        "bench_area": MILANO,
+        "metrics": [NUOVI_POSITIVI],
+        "dtw_params": {"paa_window": 7, "global_constraint": "sakoe_chiba", "sakoe_chiba_radius": 28},
+    },
+}
@@ -0,0 +1,163 @@
+"""Region by region distances, shared by the sort functions.
+
+The matrices are computed once for each version of the data and kept on disk.
+When days are appended, the euclidean distances are updated with the new days only.
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from constants import DISTANCE_STORE, DISTANCE_TAIL_DAYS, REGION
+import manage_input
+import metrics
+
+METRICS = ("euclidean", "spearman")
+
+# The store of the last data version seen by this process, for each granularity
+_store_cache = {}
+
+
+def get_data_key(values, regions):
+    """Returns a hash of the data.
+
+    Args:
+        values (numpy.ndarray): (n.days * n.regions) values
+        regions (list of str): region names
+
+    Returns:
+        str: hex digest
+    """
+
+    digest = hashlib.sha256("\0".join(regions).encode("utf-8"))
+    digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+
+    return digest.hexdigest()
+
+
+def read_store(granularity=REGION):
+    """Reads the stored distances.
+
+    Args:
+        granularity (str): a key of GRANULARITIES
+
+    Returns:
+        dict of (str, numpy.ndarray): the stored arrays, None if missing
+    """
+
+    return manage_input.read_npz(manage_input.get_granularity_file(DISTANCE_STORE, granularity))
+
+
+def write_store(store, granularity=REGION):
+    """Stores the distances on disk.
+
+    Args:
+        store (dict of (str, numpy.ndarray)): the arrays to store
+        granularity (str): a key of GRANULARITIES
+    """
+
+    manage_input.write_npz(manage_input.get_granularity_file(DISTANCE_STORE, granularity), store)
+
+
+def get_squared_distance_sums(values):
+    """Sums over the days of the squared differences between each pair of regions.
+
+    Args:
+        values (numpy.ndarray): (n.days * n.regions) values
+
+    Returns:
+        numpy.ndarray: (n.regions * n.regions) sums
+    """
+
+    gram = values.T @ values
+    norms = np.diag(gram)
+
+    return np.maximum(norms[:, np.newaxis] + norms[np.newaxis, :] - 2 * gram, 0)
+
+
+def update_squared_distance_sums(store, values, dates):
+    """Updates the stored sums with the days that were appended or changed.
+
+    Only the last DISTANCE_TAIL_DAYS stored days may have changed: the older ones are checked by hash.
+
+    Args:
+        store (dict of (str, numpy.ndarray)): the stored arrays
+        values (numpy.ndarray): (n.days * n.regions) current values
+        dates (numpy.ndarray): current days
+
+    Returns:
+        numpy.ndarray: (n.regions * n.regions) sums, None if they must be computed from scratch
+    """
+
+    n_old_days = len(store["dates"])
+    tail_start = n_old_days - len(store["tail"])
+    if (
+        len(dates) < n_old_days
+        or not np.array_equal(dates[:n_old_days], store["dates"])
+        or str(store["head_key"]) != get_data_key(values[:tail_start], list(store["regions"]))
+    ):
+        return None
+
+    # First stored day that changed
+    changed = np.any(values[tail_start:n_old_days] != store["tail"], axis=1)
+    first_changed = tail_start + (changed.argmax() if changed.any() else len(changed))
+
+    sums = store["sq_sums"] - get_squared_distance_sums(store["tail"][first_changed - tail_start:])
+    sums += get_squared_distance_sums(values[first_changed:])
+
+    return np.maximum(sums, 0)
+
+
+@metrics.timed("get_distances")
+def get_distances(log_pivot_regs, metric, granularity=REGION):
+    """Returns the distances (or similarities) between the regions.
+
+    Args:
+        log_pivot_regs (pandas.DataFrame): The data (n.days * n.regions), without NaN values
+        metric (str): "euclidean" or "spearman" (a correlation: higher is closer)
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+
+    Returns:
+        pandas.DataFrame: (n.regions * n.regions) matrix
+    """
+
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+
+    regions = [str(r) for r in log_pivot_regs.columns]
+    values = log_pivot_regs.values.astype(float)
+    key = get_data_key(values, regions)
+
+    store = _store_cache.get(granularity)
+    if store is None or str(store["key"]) != key:
+        store = read_store(granularity)
+    if store is None or list(store["regions"]) != regions:
+        store = None
+
+    modified = store is None or str(store["key"]) != key
+    metrics.count("distances", not modified and metric in store)
+    if modified:
+        dates = log_pivot_regs.index.values.astype("datetime64[ns]")  # Without the dtype metadata of unpickled frames
+        sums = update_squared_distance_sums(store, values, dates) if store is not None else None
+        if sums is None:
+            sums = get_squared_distance_sums(values)
+
+        tail_start = max(len(values) - DISTANCE_TAIL_DAYS, 0)
+        store = {
+            "key": np.array(key),
+            "regions": np.array(regions, dtype=str),
+            "dates": dates,
+            "head_key": np.array(get_data_key(values[:tail_start], regions)),
+            "tail": values[tail_start:],
+            "sq_sums": sums,
+            "euclidean": np.sqrt(sums),
+        }
+
+    if metric not in store:
+        store[metric] = log_pivot_regs.corr(method="spearman").values
+        modified = True
+    if modified:
+        write_store(store, granularity)
+    _store_cache[granularity] = store
+
+    return pd.DataFrame(store[metric], index=log_pivot_regs.columns, columns=log_pivot_regs.columns)
@@ -0,0 +1,301 @@
+"""Size-bounded store for the plot images, versioned nightly artifacts.
+
+Plots are kept in the images directory until its budget is exceeded, then the least recently used ones are deleted.
+The modification time of a file records its last use. Nightly artifacts (heatmaps, cluster plot) are never evicted:
+each nightly run builds them in a new version directory, published by swapping a symbolic link.
+"""
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from constants import (
+    ARTIFACTS,
+    ARTIFACTS_CURRENT,
+    ARTIFACTS_KEEP,
+    IMAGES,
+    IMAGES_LOCK,
+    IMAGES_MAX_BYTES,
+    IMAGES_MAX_ENTRIES,
+    NIGHTLY_BUDGET,
+    RENDER_LOCKS,
+    RENDER_LOCK_STRIPES,
+    RESET_LOCK,
+)
+
+PINNED_PREFIXES = ("heatmap_", "peaks_")
+BUILD_PREFIX = ".build-"
+
+# Counters of this process
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+_stats_lock = threading.Lock()
+
+# Keys are hashed to a fixed set of locks, so lock files do not pile up
+_render_locks = [threading.Lock() for _ in range(RENDER_LOCK_STRIPES)]
+# The scheduled operations hold their lock for minutes: renders must not share it
+_reset_lock = threading.Lock()
+
+
+def _count(name, n=1):
+    """Increments a counter."""
+
+    with _stats_lock:
+        _stats[name] += n
+
+
+def get_stats():
+    """Returns the hit, miss and eviction counters of this process.
+
+    Returns:
+        dict of (str, int): counter name, value
+    """
+
+    with _stats_lock:
+        return dict(_stats)
+
+
+@contextlib.contextmanager
+def file_lock(lock_path):
+    """Holds an exclusive lock on a file, shared by all processes.
+
+    Args:
+        lock_path (str): path of the lock file, created if missing
+    """
+
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def single_flight(key):
+    """Runs a block for a key in one thread of one process at a time.
+
+    Concurrent requests for the same key wait for the running one: after entering,
+    check again whether the result is already there.
+
+    Args:
+        key (str): the image file name being rendered
+    """
+
+    stripe = int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % RENDER_LOCK_STRIPES
+    locks_dir = os.path.join(IMAGES, RENDER_LOCKS)
+    os.makedirs(locks_dir, exist_ok=True)
+
+    with _render_locks[stripe]:  # Threads of this process
+        with file_lock(os.path.join(locks_dir, f"{stripe}.lock")):  # Other processes
+            yield
+
+
+@contextlib.contextmanager
+def reset_lock():
+    """Runs the scheduled operations in one thread of one process at a time.
+
+    The lock is not shared with the renders, which keep going while the scheduled operations run.
+    """
+
+    os.makedirs(IMAGES, exist_ok=True)
+
+    with _reset_lock:  # Threads of this process
+        with file_lock(os.path.join(IMAGES, RESET_LOCK)):  # Other processes
+            yield
+
+
+def exists(filename):
+    """Checks whether an image is stored, without counting it as a use.
+
+    Args:
+        filename (str): name of the image
+
+    Returns:
+        bool: True if the image is in the store
+    """
+
+    return os.path.isfile(os.path.join(IMAGES, filename))
+
+
+def lookup(filename):
+    """Checks whether an image is stored and marks it as used.
+
+    Args:
+        filename (str): name of the image
+
+    Returns:
+        bool: True if the image is in the store
+    """
+
+    try:
+        os.utime(os.path.join(IMAGES, filename))  # Last use, for the LRU order
+    except FileNotFoundError:
+        _count("misses")
+        return False
+
+    _count("hits")
+    return True
+
+
+def get_tmp_path(filename):
+    """Returns a private path to render an image to, before storing it.
+
+    Args:
+        filename (str): name of the image
+
+    Returns:
+        str: a hidden path in the images directory, unique to this thread
+    """
+
+    return os.path.join(IMAGES, f".{filename}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def store(tmp_path, filename, max_bytes=IMAGES_MAX_BYTES, max_entries=IMAGES_MAX_ENTRIES):
+    """Moves a rendered image into the store, then enforces the budget.
+
+    Args:
+        tmp_path (str): path the image was rendered to
+        filename (str): name of the image
+        max_bytes (int): maximum total size of the evictable images
+        max_entries (int): maximum number of evictable images
+    """
+
+    os.replace(tmp_path, os.path.join(IMAGES, filename))  # Readers see either no file or the whole file
+    evict(max_bytes, max_entries)
+
+
+def evict(max_bytes=IMAGES_MAX_BYTES, max_entries=IMAGES_MAX_ENTRIES):
+    """Deletes the least recently used images until the store is within budget.
+
+    Args:
+        max_bytes (int): maximum total size of the evictable images
+        max_entries (int): maximum number of evictable images
+    """
+
+    with file_lock(os.path.join(IMAGES, IMAGES_LOCK)):
+        entries = []
+        with os.scandir(IMAGES) as it:
+            for entry in it:
+                if entry.name.startswith(".") or entry.name.startswith(PINNED_PREFIXES):
+                    continue
+                try:
+                    file_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.is_file():
+                    entries.append((file_stat.st_mtime_ns, file_stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        n_entries = len(entries)
+        for _, size, path in sorted(entries):  # Oldest use first
+            if total_bytes <= max_bytes and n_entries <= max_entries:
+                break
+            try:
+                os.remove(path)
+                _count("evictions")
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            n_entries -= 1
+
+
+def get_artifacts_version():
+    """Returns the published version of the nightly artifacts.
+
+    Returns:
+        str: name of the version directory, None if no version was published
+    """
+
+    try:
+        return os.readlink(os.path.join(IMAGES, ARTIFACTS, ARTIFACTS_CURRENT))
+    except FileNotFoundError:
+        return None
+
+
+def get_artifacts_dir():
+    """Returns the directory of the published nightly artifacts.
+
+    Returns:
+        str: path of the directory, None if no version was published
+    """
+
+    version = get_artifacts_version()
+    if version is None:
+        return None
+    return os.path.join(IMAGES, ARTIFACTS, version)
+
+
+def delete_stale_builds(max_age=NIGHTLY_BUDGET):
+    """Deletes the build directories left behind by interrupted nightly runs.
+
+    A build still running was modified within the nightly budget.
+
+    Args:
+        max_age (float): seconds since the last change after which a build directory is deleted
+    """
+
+    artifacts_root = os.path.join(IMAGES, ARTIFACTS)
+    now = time.time()
+    with os.scandir(artifacts_root) as it:
+        for entry in it:
+            if not entry.name.startswith(BUILD_PREFIX):
+                continue
+            try:
+                build_mtime = entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+            if now - build_mtime > max_age:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def new_artifacts_dir():
+    """Creates a private directory to build the nightly artifacts into, after deleting the stale ones.
+
+    Returns:
+        str: path of the directory, to be published with publish_artifacts
+    """
+
+    artifacts_root = os.path.join(IMAGES, ARTIFACTS)
+    os.makedirs(artifacts_root, exist_ok=True)
+    delete_stale_builds()
+    build_dir = tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=artifacts_root)
+    os.chmod(build_dir, 0o755)  # Served once published
+
+    return build_dir
+
+
+def publish_artifacts(build_dir, keep=ARTIFACTS_KEEP):
+    """Publishes a complete build of the nightly artifacts, then deletes the oldest versions.
+
+    The link to the current version is replaced in one rename: readers see either the old or the new version.
+
+    Args:
+        build_dir (str): directory returned by new_artifacts_dir, with all the artifacts in it
+        keep (int): versions to keep, including the published one
+
+    Returns:
+        str: the published version
+    """
+
+    artifacts_root = os.path.join(IMAGES, ARTIFACTS)
+    version = time.strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+    os.rename(build_dir, os.path.join(artifacts_root, version))
+
+    tmp_link = os.path.join(artifacts_root, f".{ARTIFACTS_CURRENT}-{os.getpid()}")
+    os.symlink(version, tmp_link)
+    os.replace(tmp_link, os.path.join(artifacts_root, ARTIFACTS_CURRENT))
+
+    # Versions are named after their build time
+    versions = sorted(
+        name for name in os.listdir(artifacts_root)
+        if not name.startswith(".") and name != ARTIFACTS_CURRENT
+    )
+    for old_version in versions[:-keep]:
+        if old_version != version:
+            shutil.rmtree(os.path.join(artifacts_root, old_version), ignore_errors=True)
+
+    return version
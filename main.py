@@ -1,12 +1,19 @@
 """ This file is used to generate the dynamic Html of the webpage. If not a web app, executes compare_regions()"""
 
+import functools
+import hashlib
+import json
 import os
 
-from flask import Flask, request
+from flask import Flask, abort, jsonify, make_response, request
+
+from constants import DATA_MAX_AGE, GRANULARITIES, NUOVI_POSITIVI, REGION
 
 import manage_app
 import manage_input
 import manage_output
+import metrics
+import profiling
 import tasks
 
 
@@ -14,19 +21,43 @@ app = Flask(__name__)
 app.config["DEBUG"] = False
 
 
+def profiled_view(view):
+    """Profiles the requests to a view that are signed for it, or all of them if COVCOMPARE_PROFILE is set.
+
+    The name of the profile is returned in the X-Profile header.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        mode = profiling.get_request_mode(request.args)
+        if mode is None:
+            return view(*args, **kwargs)
+        with profiling.profile(view.__name__, mode) as run:
+            response = make_response(view(*args, **kwargs))
+        response.headers["X-Profile"] = os.path.basename(run)
+        return response
+
+    return wrapper
+
+
 @app.route("/", methods=["GET", "POST"])
+@profiled_view
+@metrics.timed("compare_region_cov")
 def compare_region_cov():
     """Builds a webpage.
 
     Called on loading the page or after an http post
 
     Returns:
-        str: Html of the page to be built
+        flask.Response: Html of the page to be built, varying on the Accept header
     """
 
     error_message = ""
-    pop = manage_input.get_pop()  # Get regions-population data
-    regions = manage_app.get_default_values()  # Find the first areas to show
+    granularity = get_granularity()
+    metric = get_metric(granularity)
+    with metrics.span("get_inputs"):
+        pop = manage_input.get_pop(granularity)  # Get regions-population data
+        regions = manage_app.get_default_values(granularity)  # Find the first areas to show
 
     if request.method == "POST":
         try:
@@ -36,13 +67,125 @@ def compare_region_cov():
             # Something went wrong with the input parsing
             error_message = manage_output.incorrect_input_message()
 
-    # Gets the file name of the plot to display
-    plot_filename = tasks.get_plot_file(regions, pop)
-    heatmap_filename = tasks.get_heatmap_file('pca')
+    # Gets the file name of the plot to display, in a format the client accepts
+    render_params = manage_output.negotiate_render_params(
+        request.accept_mimetypes, request.args.get("format"), request.args.get("size")
+    )
+    plot_filename = tasks.get_plot_file(regions, pop, render_params, granularity, metric)
+    heatmap_filename = tasks.get_heatmap_file('pca', granularity)
+
+    return_page = tasks.build_page(error_message, plot_filename, regions, pop, heatmap_filename, granularity, metric)
+
+    # The page links an image whose format depends on the Accept header: caches must key on it
+    response = make_response(return_page)
+    response.vary.add("Accept")
+    return response
+
+
+def get_granularity():
+    """Returns the granularity of the request, from the level argument: region by default.
+
+    Aborts with 404 if the level is unknown or its population table is missing,
+    with 503 if its data were not downloaded yet by the scheduled operations.
+    """
+
+    granularity = request.args.get("level", REGION)
+    if granularity not in GRANULARITIES or not manage_input.has_population(granularity):
+        abort(404)
+    if not manage_input.has_data(granularity):
+        abort(503)
+    return granularity
+
+
+def get_metric(granularity):
+    """Returns the metric of the request, from the metric argument or form field: new cases by default.
+
+    Aborts with 404 if the granularity has no such metric.
+    """
+
+    metric = request.values.get("metric", NUOVI_POSITIVI)
+    if metric not in GRANULARITIES[granularity]["metrics"]:
+        abort(404)
+    return metric
+
+
+def get_step():
+    """Returns the downsampling step of the request: one day out of step is kept."""
+
+    step = int(request.args.get("step", 1))
+    if step < 1:
+        raise ValueError("step must be positive")
+    return step
+
+
+@app.route("/data", methods=["GET"])
+@metrics.timed("region_series")
+def region_series():
+    """Returns the raw and transformed values of the selected regions, as JSON.
+
+    Query arguments: regions (repeated), step (optional downsampling), level (optional granularity),
+    metric (optional, new cases by default).
+    Responses can be cached by the browser and revalidated with their ETag.
+
+    Returns:
+        flask.Response: JSON with dates, regions, raw and transformed values
+    """
+
+    granularity = get_granularity()
+    metric = get_metric(granularity)
+    pop = manage_input.get_pop(granularity)
+    try:
+        regions = manage_input.validate_input(request.args.getlist("regions"), pop)
+        step = get_step()
+    except (AssertionError, ValueError):
+        abort(400)
+
+    # The content only depends on the data version and the query
+    data_version = manage_input.get_data_version(GRANULARITIES[granularity]["csv_url"])
+    cache_key = json.dumps([data_version, manage_output.canonical_regions(regions), step, granularity, metric])
+    etag = hashlib.sha256(cache_key.encode("utf-8")).hexdigest()[:32]
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(tasks.get_series(regions, pop, step, granularity, metric))
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = DATA_MAX_AGE
+
+    return response
+
+
+@app.route("/chart", methods=["GET"])
+def compare_region_chart():
+    """Builds a webpage whose charts are drawn in the browser, from the /data endpoint.
+
+    Returns:
+        str: Html of the page to be built
+    """
+
+    granularity = get_granularity()
+    metric = get_metric(granularity)
+    pop = manage_input.get_pop(granularity)
+    regions = manage_app.get_default_values(granularity)
+    try:
+        step = get_step()
+    except ValueError:
+        abort(400)
+
+    return tasks.build_chart_page(regions, pop, step, granularity, metric)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_page():
+    """Returns the timings and cache counters of this process, in the Prometheus text format.
+
+    Not found unless the metrics are enabled with COVCOMPARE_METRICS.
+    """
 
-    return_page = tasks.build_page(error_message, plot_filename, regions, pop, heatmap_filename)
+    if not metrics.METRICS_ENABLED:
+        abort(404)
 
-    return return_page
+    return app.response_class(metrics.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
 
 
 # For development purposes
@@ -1,95 +1,290 @@
 """Functions used to treat the data. """
 
+import os
+
 import numpy as np
 import pandas as pd
 
 from constants import (
-    LOMBARDIA,
-    CSV_URL,
+    DATA,
+    DATA_METRICS,
     DENOMINAZIONE_REGIONE,
     DEFAULT_START,
+    GRANULARITIES,
     NUOVI_POSITIVI,
+    REGION,
+    ROLLING_WINDOW,
+    TRANSFORMED_STORE,
 )
+import image_store
 import manage_input
 import manage_output
+import metrics
+
+# Raw and transformed values of all the regions, computed once per dataset, for each granularity:
+# (cov_df, store, frames) tuples, replaced as a whole
+_all_regions_cache = {}
 
 
-def filter_regional_data(cov_df, regions):
+def filter_regional_data(cov_df, regions, area_column=DENOMINAZIONE_REGIONE):
     """Keeps the selected regions only.
 
     Args:
         cov_df (pandas.DataFrame): vertical data
         regions (list of str): regions to be returned as columns
+        area_column (str): names of the areas
 
     Returns:
         pandas.DataFrame: the selected regions only
     """
 
-    cov_regs = cov_df[cov_df[DENOMINAZIONE_REGIONE].isin(regions)]
+    cov_regs = cov_df[cov_df[area_column].isin(regions)]
 
     return cov_regs
 
 
-def pivot_regional_data(cov_regs):
-    """Places region data into columns.
+def pivot_raw_data(cov_regs, area_column=DENOMINAZIONE_REGIONE):
+    """Places region data into columns, as they are.
 
     Args:
         cov_regs (pandas.DataFrame): all the data, verticalized
+        area_column (str): names of the areas
 
     Returns:
         pandas.DataFrame: regions pivoted as columns
     """
 
     pivot_regs = pd.pivot_table(
-        cov_regs, index="data", values=[NUOVI_POSITIVI], columns=[DENOMINAZIONE_REGIONE]
+        cov_regs, index="data", values=[NUOVI_POSITIVI], columns=[area_column], observed=True
     )
     pivot_regs = pivot_regs.droplevel(None, axis=1)
-    pivot_regs = pivot_regs.where(pivot_regs > 0).fillna(
-        method="bfill"
+    pivot_regs.columns = pivot_regs.columns.astype(str)  # Region names are categorical in the data
+
+    return pivot_regs
+
+
+def pivot_regional_data(cov_regs, area_column=DENOMINAZIONE_REGIONE):
+    """Places region data into columns.
+
+    Args:
+        cov_regs (pandas.DataFrame): all the data, verticalized
+        area_column (str): names of the areas
+
+    Returns:
+        pandas.DataFrame: regions pivoted as columns
+    """
+
+    pivot_regs = pivot_raw_data(cov_regs, area_column)
+    pivot_regs = pd.DataFrame(
+        backfill_nonpositive(pivot_regs.values), index=pivot_regs.index, columns=pivot_regs.columns
     )  # Last value if the current one is inappropriate
 
     return pivot_regs
 
 
-def normalize_smooth(pivot_regs, pop, bench_region):
+def pivot_cube(cov_regs, metric_names, area_column=DENOMINAZIONE_REGIONE):
+    """Places the data of several metrics into one array, in one pass over the rows.
+
+    Days are sorted, regions are in the order of their categories, as in pivot_raw_data.
+
+    Args:
+        cov_regs (pandas.DataFrame): all the data, verticalized
+        metric_names (list of str): value columns
+        area_column (str): names of the areas
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray): days, regions, (n.metrics * n.days * n.regions) values
+    """
+
+    dates, day_codes = np.unique(cov_regs[DATA].values, return_inverse=True)
+    areas = pd.Categorical(cov_regs[area_column])
+    area_codes, region_codes = np.unique(areas.codes, return_inverse=True)  # Observed regions only
+    regions = np.array(areas.categories[area_codes], dtype=str)
+
+    cube = np.full((len(metric_names), len(dates), len(regions)), np.nan)
+    cube[:, day_codes, region_codes] = cov_regs[list(metric_names)].values.T
+
+    return dates, regions, cube
+
+
+def get_daily_values(raw, metric_names):
+    """Turns the cumulative metrics of a cube into daily values. The first day is kept as it is.
+
+    Args:
+        raw (numpy.ndarray): (n.metrics * n.days * n.regions) values
+        metric_names (list of str): keys of DATA_METRICS, one per row of the cube
+
+    Returns:
+        numpy.ndarray: daily values
+    """
+
+    daily = raw.copy()
+    cumulative = np.array([DATA_METRICS[metric]["cumulative"] for metric in metric_names], dtype=bool)
+    daily[cumulative, 1:] = np.diff(raw[cumulative], axis=-2)
+
+    return daily
+
+
+def backfill_nonpositive(values, started=None, keep_zeros=False):
+    """Replaces non-positive and missing values with the next valid value.
+
+    Days are on the second-to-last axis. The days before the first observation of a series are left missing:
+    a metric that was not reported yet has no history.
+
+    Args:
+        values (numpy.ndarray): (n.days * n.regions) values
+        started (numpy.ndarray): (n.regions) True for the series observed before the first day,
+            when the values are the tail of longer series
+        keep_zeros (bool or numpy.ndarray): True if zeros are valid values, or one flag per row of a cube
+
+    Returns:
+        numpy.ndarray: float values, NaN if no valid value follows or the series is not observed yet
+    """
+
+    values = np.asarray(values, dtype=float)
+    n_days = values.shape[-2]
+
+    observed = np.logical_or.accumulate(~np.isnan(values), axis=-2)
+    if started is not None:
+        observed |= started[..., np.newaxis, :]
+
+    keep_zeros = np.asarray(keep_zeros, dtype=bool).reshape(np.shape(keep_zeros) + (1, 1))
+    with np.errstate(invalid="ignore"):
+        valid = (values > 0) | (keep_zeros & (values == 0))
+    day_index = np.arange(n_days)[:, np.newaxis]
+    valid_index = np.where(valid, day_index, n_days)  # n_days points to a NaN pad row
+    next_valid_index = np.minimum.accumulate(valid_index[..., ::-1, :], axis=-2)[..., ::-1, :]
+
+    nan_row = np.full(values.shape[:-2] + (1, values.shape[-1]), np.nan)
+    padded_values = np.concatenate([values, nan_row], axis=-2)
+
+    filled = np.take_along_axis(padded_values, next_valid_index, axis=-2)
+
+    return np.where(observed, filled, np.nan)
+
+
+def backfill_metrics(daily, metric_names, started=None):
+    """Backfills the daily values of a cube. The zeros of the stock metrics are kept.
+
+    Args:
+        daily (numpy.ndarray): (n.metrics * n.days * n.regions) values
+        metric_names (list of str): keys of DATA_METRICS, one per row of the cube
+        started (numpy.ndarray): (n.metrics * n.regions) True for the series observed before the first day
+
+    Returns:
+        numpy.ndarray: backfilled values
+    """
+
+    stock = np.array([DATA_METRICS[metric]["stock"] for metric in metric_names], dtype=bool)
+
+    return backfill_nonpositive(daily, started, keep_zeros=stock)
+
+
+def rolling_mean(values, window=ROLLING_WINDOW):
+    """Trailing mean over a window of days, computed with cumulative sums.
+
+    Same as pandas rolling(window).mean(): NaN if the window is incomplete or has a missing value.
+
+    Args:
+        values (numpy.ndarray): (n.days * n.regions) values
+        window (int): days in the window
+
+    Returns:
+        numpy.ndarray: smoothed values
+    """
+
+    values = np.asarray(values, dtype=float)
+    n_days = values.shape[-2]
+    missing = np.isnan(values)
+
+    zero_row = np.zeros(values.shape[:-2] + (1, values.shape[-1]))
+    sums = np.concatenate([zero_row, np.cumsum(np.where(missing, 0.0, values), axis=-2)], axis=-2)
+    missing_counts = np.concatenate([zero_row, np.cumsum(missing, axis=-2)], axis=-2)
+
+    window_sums = sums[..., window:, :] - sums[..., :-window, :]
+    window_missing = missing_counts[..., window:, :] - missing_counts[..., :-window, :]
+    means = np.where(window_missing > 0, np.nan, window_sums / window)
+
+    head = np.full(values.shape[:-2] + (min(window - 1, n_days), values.shape[-1]), np.nan)
+
+    return np.concatenate([head, means], axis=-2)
+
+
+def get_pop_ratios(pop, regions, bench_region):
+    """Returns the population of a benchmark region over the population of each region.
+
+    Args:
+        pop (pandas.Series): region, population
+        regions (list of str): regions to normalize
+        bench_region (str): Benchmark region
+
+    Returns:
+        numpy.ndarray: one ratio per region
+    """
+
+    return pop[bench_region] / pop[list(regions)].values.astype(float)
+
+
+def transform_values(values, pop_ratios, window=ROLLING_WINDOW):
+    """Normalizes, smooths and log-transforms the values in one pass.
+
+    Args:
+        values (numpy.ndarray): (n.days * n.regions) raw values, without negative values
+        pop_ratios (numpy.ndarray): population ratio of each region
+        window (int): days in the smoothing window
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): smoothed values, log2 of the smoothed values, NaN where they are zero
+    """
+
+    roll_values = rolling_mean(values * pop_ratios, window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_values = np.where(roll_values > 0, np.log2(roll_values), np.nan)
+
+    return roll_values, log_values
+
+
+def normalize_smooth(pivot_regs, pop, bench_region, window=ROLLING_WINDOW):
     """Divides data by population, applies a rolling mean.
 
     Args:
         pivot_regs (pandas.DataFrame): regions are column names
         pop (pandas.Series): region, population
         bench_region (str): Benchmark region
+        window (int): days in the smoothing window
 
     Returns:
         pandas.DataFrame: normalized and smoothed DataFrame
     """
 
-    norm_pivot_regs = pivot_regs.copy()
-    available_regions = list(norm_pivot_regs.columns)
-
-    # Normalize the population based on a benchmark region
-    norm_pivot_regs *= pop[bench_region]
-    for region in available_regions:
-        norm_pivot_regs[region] /= pop[region]
-
-    # Smooth the data
-    roll_pivot_regs = norm_pivot_regs.rolling(7).mean()
+    # Normalize the population based on a benchmark region, then smooth the data
+    pop_ratios = get_pop_ratios(pop, pivot_regs.columns, bench_region)
+    roll_values = rolling_mean(pivot_regs.values * pop_ratios, window)
+    roll_pivot_regs = pd.DataFrame(roll_values, index=pivot_regs.index, columns=pivot_regs.columns)
 
     return roll_pivot_regs
 
 
-def get_default_values():
+def get_default_values(granularity=REGION):
     """Returns the regions chosen for the default page.
 
+    Args:
+        granularity (str): a key of GRANULARITIES
+
     Returns:
         list of str: the highest and lowest-value regions
 
     """
 
-    # Reads the default start file
-    default_regions = [LOMBARDIA]
+    # Reads the default start file, the published one if any
+    default_regions = [GRANULARITIES[granularity]["bench_area"]]
+    artifacts_dir = image_store.get_artifacts_dir()
+    default_start = manage_input.get_granularity_file(DEFAULT_START, granularity)
+    if artifacts_dir is not None:
+        default_start = os.path.join(artifacts_dir, default_start)
     try:
         # The default regions should be chosen by the scheduled script
-        with open(DEFAULT_START, "r") as f:
+        with open(default_start, "r") as f:
             min_region = f.readline().strip()
             max_region = f.readline().strip()
             default_regions = [min_region, max_region]
@@ -99,29 +294,277 @@ def get_default_values():
     return default_regions
 
 
-def get_raw_log_data(cov_df, regions, pop):
+def get_all_raw_log_data(cov_df, pop, granularity=REGION, metric=NUOVI_POSITIVI):
+    """Returns the raw and transformed values of all the regions, for a metric.
+
+    The values of all the metrics are computed once for each dataset and kept in memory:
+    a metric is a slice of the cube, and a subset of regions is obtained by slicing the columns.
+
+    Args:
+        cov_df (pandas.DataFrame): raw data
+        pop (pandas.Series): region, population
+        granularity (str): a key of GRANULARITIES, the granularity of the data
+        metric (str): a key of DATA_METRICS among the metrics of the granularity
+
+    Returns:
+        (pandas.DataFrame, pandas.DataFrame): raw values, transformed values
     """
 
+    # get_df returns the same object until the data change
+    entry = _all_regions_cache.get(granularity)
+    metrics.count("all_regions", entry is not None and entry[0] is cov_df)
+    if entry is None or entry[0] is not cov_df:
+        options = GRANULARITIES[granularity]
+        store = read_transformed_store(granularity)
+        data_version = manage_input.get_data_version(options["csv_url"])
+        if (
+            store is None
+            or str(store["version"]) != data_version
+            or list(store.get("metrics", [])) != options["metrics"]
+        ):
+            metrics.count("transformed_store", False)
+            store = compute_transformed_store(cov_df, pop, granularity=granularity)
+        else:
+            metrics.count("transformed_store", True)
+        entry = cache_transformed_store(cov_df, store, granularity)
+
+    return get_metric_frames(entry, granularity, metric)
+
+
+@metrics.timed("compute_transformed_store")
+def compute_transformed_store(cov_df, pop, window=ROLLING_WINDOW, granularity=REGION):
+    """Computes the all-regions arrays from scratch.
+
     Args:
         cov_df (pandas.DataFrame): raw data
-        regions (list of str): regions to be returned as columns
         pop (pandas.Series): region, population
+        window (int): days in the smoothing window
+        granularity (str): a key of GRANULARITIES, the granularity of the data
+
+    Returns:
+        dict of (str, numpy.ndarray): metrics, dates, regions, raw, daily, backfilled and transformed values
+    """
+
+    options = GRANULARITIES[granularity]
+    metric_names = options["metrics"]
+    dates, regions, raw = pivot_cube(cov_df, metric_names, options["area_column"])  # Get the raw values
+    pop_ratios = get_pop_ratios(pop, regions, options["bench_area"])
+    daily = get_daily_values(raw, metric_names)
+    filled = backfill_metrics(daily, metric_names)
+    _, log_values = transform_values(filled, pop_ratios, window)  # Get the transformed values
+
+    store = {
+        "metrics": np.array(metric_names, dtype=str),
+        "dates": dates,
+        "regions": regions,
+        "pop_ratios": pop_ratios,
+        "window": np.array(window),
+        "raw": raw,
+        "daily": daily,
+        "filled": filled,
+        "log": log_values,
+    }
+
+    return store
+
+
+def cache_transformed_store(cov_df, store, granularity=REGION):
+    """Keeps the all-regions data in memory. The DataFrames of a metric are built on first use.
+
+    The cache entry is replaced in one assignment: a thread holding the previous entry keeps using
+    the store and frames it belongs to.
+
+    Args:
+        cov_df (pandas.DataFrame): raw data the store was computed from
+        store (dict of (str, numpy.ndarray)): all-regions arrays
+        granularity (str): a key of GRANULARITIES, the granularity of the data
+
+    Returns:
+        tuple: the cache entry, (cov_df, store, frames)
+    """
+
+    entry = (cov_df, store, {})
+    _all_regions_cache[granularity] = entry
+
+    return entry
+
+
+def get_metric_frames(entry, granularity=REGION, metric=NUOVI_POSITIVI):
+    """Returns the all-regions data of a metric, as DataFrames viewing the cube of a cache entry.
+
+    Args:
+        entry (tuple): a cache entry returned by cache_transformed_store
+        granularity (str): a key of GRANULARITIES, the granularity of the data
+        metric (str): a key of DATA_METRICS among the metrics of the granularity
 
     Returns:
         (pandas.DataFrame, pandas.DataFrame): raw values, transformed values
     """
 
-    cov_regs = filter_regional_data(cov_df, regions)
-    pivot_regs = pivot_regional_data(cov_regs)  # Get the raw values
+    _, store, frames = entry
+    if metric not in frames:
+        metric_index = list(store["metrics"]).index(metric)
+        index = pd.DatetimeIndex(store["dates"], name=DATA)
+        columns = pd.Index(store["regions"], name=GRANULARITIES[granularity]["area_column"])
+        frames[metric] = (
+            pd.DataFrame(store["filled"][metric_index], index=index, columns=columns),
+            pd.DataFrame(store["log"][metric_index], index=index, columns=columns),
+        )
+
+    return frames[metric]
+
+
+def read_transformed_store(granularity=REGION):
+    """Reads the all-regions data stored by the scheduled operations.
+
+    Args:
+        granularity (str): a key of GRANULARITIES
+
+    Returns:
+        dict of (str, numpy.ndarray): the stored arrays, None if missing
+    """
+
+    return manage_input.read_npz(manage_input.get_granularity_file(TRANSFORMED_STORE, granularity))
+
+
+def write_transformed_store(store, granularity=REGION):
+    """Stores the all-regions data on disk.
+
+    Args:
+        store (dict of (str, numpy.ndarray)): all-regions arrays
+        granularity (str): a key of GRANULARITIES
+    """
+
+    manage_input.write_npz(manage_input.get_granularity_file(TRANSFORMED_STORE, granularity), store)
+
+
+@metrics.timed("append_transformed_days")
+def append_transformed_days(store, cov_df, pop_ratios, window=ROLLING_WINDOW, area_column=DENOMINAZIONE_REGIONE):
+    """Appends the new days to the stored data and recomputes the affected tail only.
+
+    A backfilled value only depends on the following days, a smoothed value on the preceding window,
+    a daily value of a cumulative metric on the day before.
+    Only the days from the first unfilled one onwards, plus a window before them, are transformed again.
+
+    Args:
+        store (dict of (str, numpy.ndarray)): all-regions arrays
+        cov_df (pandas.DataFrame): raw data, including the stored days
+        pop_ratios (numpy.ndarray): population ratio of each region
+        window (int): days in the smoothing window
+        area_column (str): names of the areas
+
+    Returns:
+        dict of (str, numpy.ndarray): the updated arrays, None if they must be computed from scratch
+    """
+
+    # Parameters and history must match the stored ones
+    if not (np.array_equal(store["pop_ratios"], pop_ratios) and int(store["window"]) == window):
+        return None
+    metric_names = list(store["metrics"])
+    last_day = store["dates"][-1]
+    last_day_count = (cov_df[DATA] <= last_day).sum()
+    new_dates, new_regions, new_raw = pivot_cube(cov_df[cov_df[DATA] >= last_day], metric_names, area_column)
+    if (
+        last_day_count != store["raw"][0].size  # One row per region and day
+        or list(new_regions) != list(store["regions"])
+        or not np.allclose(new_raw[:, 0], store["raw"][:, -1], rtol=0, atol=0, equal_nan=True)
+    ):
+        return None
+
+    n_old_days = len(store["dates"])
+    raw = np.concatenate([store["raw"], new_raw[:, 1:]], axis=-2)
+    daily = np.concatenate([store["daily"], get_daily_values(new_raw, metric_names)[:, 1:]], axis=-2)
+
+    # First day whose backfilled value is still missing, in any metric: days before the first observation stay so
+    observed = np.logical_or.accumulate(~np.isnan(store["daily"]), axis=-2)
+    pending = observed & np.isnan(store["filled"])
+    first_missing = np.where(pending.any(axis=-2), pending.argmax(axis=-2), n_old_days)
+    start = int(first_missing.min())
+
+    started = observed[:, start - 1] if start > 0 else None
+    filled_tail = backfill_metrics(daily[:, start:], metric_names, started)
+    filled = np.concatenate([store["filled"][:, :start], filled_tail], axis=-2)
+    roll_start = max(start - window + 1, 0)
+    _, log_tail = transform_values(filled[:, roll_start:], pop_ratios, window)
+    log_values = np.concatenate([store["log"][:, :start], log_tail[:, start - roll_start:]], axis=-2)
+
+    updated_store = dict(
+        store,
+        dates=np.concatenate([store["dates"], new_dates[1:]]),
+        raw=raw,
+        daily=daily,
+        filled=filled,
+        log=log_values,
+    )
+
+    return updated_store
+
+
+@metrics.timed("update_all_raw_log_data")
+def update_all_raw_log_data(cov_df, pop, incremental=True, granularity=REGION, metric=NUOVI_POSITIVI):
+    """Updates the stored all-regions data, used by the scheduler.
+
+    In incremental mode only the days added since the last update are processed.
+
+    Args:
+        cov_df (pandas.DataFrame): raw data
+        pop (pandas.Series): region, population
+        incremental (bool): False to recompute the whole history
+        granularity (str): a key of GRANULARITIES, the granularity of the data
+        metric (str): the metric whose values are returned
+
+    Returns:
+        (pandas.DataFrame, pandas.DataFrame): raw values, transformed values
+    """
+
+    options = GRANULARITIES[granularity]
+    store = read_transformed_store(granularity) if incremental else None
+    if store is not None and list(store.get("metrics", [])) == options["metrics"]:
+        pop_ratios = get_pop_ratios(pop, store["regions"], options["bench_area"])
+        store = append_transformed_days(store, cov_df, pop_ratios, area_column=options["area_column"])
+    else:
+        store = None
+
+    if store is None:
+        store = compute_transformed_store(cov_df, pop, granularity=granularity)
+
+    store["version"] = np.array(manage_input.get_data_version(options["csv_url"]))
+    write_transformed_store(store, granularity)
+    entry = cache_transformed_store(cov_df, store, granularity)
+
+    return get_metric_frames(entry, granularity, metric)
+
+
+@metrics.timed("get_raw_log_data")
+def get_raw_log_data(cov_df, regions, pop, granularity=REGION, metric=NUOVI_POSITIVI):
+    """Returns raw and transformed values of the selected regions.
+
+    The values are sliced from the all-regions data.
+
+    Args:
+        cov_df (pandas.DataFrame): raw data
+        regions (list of str): regions to be returned as columns
+        pop (pandas.Series): region, population
+        granularity (str): a key of GRANULARITIES, the granularity of the data
+        metric (str): a key of DATA_METRICS among the metrics of the granularity
+
+    Returns:
+        (pandas.DataFrame, pandas.DataFrame): raw values, transformed values
+    """
 
-    roll_pivot_regs = normalize_smooth(pivot_regs, pop, LOMBARDIA).dropna()
-    log_pivot_regs = np.log2(roll_pivot_regs).dropna()  # Get the transformed values
+    all_pivot_regs, all_log_pivot_regs = get_all_raw_log_data(cov_df, pop, granularity, metric)
+    columns = [region for region in all_pivot_regs.columns if region in regions]  # Keep the sorted column order
 
+    pivot_regs = all_pivot_regs[columns]
+    log_pivot_regs = all_log_pivot_regs[columns].dropna()
 
     return pivot_regs, log_pivot_regs
 
 
-def compare_regions(regions, pop, download):
+@metrics.timed("compare_regions")
+def compare_regions(
+    regions, pop, download, filename=None, render_params=None, granularity=REGION, metric=NUOVI_POSITIVI
+):
     """Plots the graphs of the chosen regions
 
     Plots both the absolute values and the transformed values.
@@ -130,16 +573,25 @@ def compare_regions(regions, pop, download):
         regions (list of str): regions to compare
         pop (pandas.Series): region, population
         download (bool): True if a new .csv file is to be downloaded
+        filename (str): name of the image file, derived from the regions if None
+        render_params (dict): format and dpi of the image, the default ones if None
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+        metric (str): a key of DATA_METRICS among the metrics of the granularity
 
     Returns:
         None
     """
 
-    cov_df = manage_input.get_df(CSV_URL, download)
-    pivot_regs, log_pivot_regs = get_raw_log_data(cov_df, regions, pop)
+    regions = manage_output.canonical_regions(regions)  # The same plot for any order of the regions
+    cov_df = manage_input.get_df(GRANULARITIES[granularity]["csv_url"], download, granularity)
+    pivot_regs, log_pivot_regs = get_raw_log_data(cov_df, regions, pop, granularity, metric)
     manage_output.plot_graphs(
         pivot_regs=pivot_regs,
         log_pivot_regs=log_pivot_regs,
         suptitle=" - ".join(regions),
         regions=regions,
+        filename=filename,
+        render_params=render_params,
+        granularity=granularity,
+        metric=metric,
     )
@@ -1,11 +1,32 @@
 """ Functions to parse and prepare the input data """
+import json
 import os
 
+import numpy as np
 import pandas as pd
 import requests
 import string
 
-from constants import POPULATION_CSV, DENSITY_CSV
+from constants import (
+    DATA,
+    DATA_METRICS,
+    DENOMINAZIONE_REGIONE,
+    DENSITY_CSV,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_HEADERS_EXT,
+    DOWNLOAD_TIMEOUT,
+    GRANULARITIES,
+    NUOVI_POSITIVI,
+    POPULATION_CSV,
+    PROVINCE,
+    REGION,
+    SNAPSHOT_COLUMNS,
+    SNAPSHOT_EXT,
+)
+import metrics
+
+# Parsed data files, kept in memory while the file on disk is unchanged
+_df_cache = {}
 
 
 def validate_input(inputs, pop):
@@ -23,13 +44,63 @@ def validate_input(inputs, pop):
     return inputs
 
 
-def get_dens():
-    """Reads in a region-density Series.
+def get_granularity_file(file_name, granularity=REGION):
+    """Returns the name of a file of a granularity: its prefix, none for the regions.
+
+    Args:
+        file_name (str): name of the region file
+        granularity (str): a key of GRANULARITIES
+
+    Returns:
+        str: name of the file
+    """
+
+    return file_name if granularity == REGION else f"{granularity}_{file_name}"
+
+
+def has_population(granularity=REGION):
+    """Tells whether the population table of a granularity is available.
+
+    The region table is written with default values when missing, the other ones by a setup function.
+
+    Args:
+        granularity (str): a key of GRANULARITIES
+
+    Returns:
+        bool: True if the data of the granularity can be normalized
+    """
+
+    return granularity == REGION or os.path.isfile(get_granularity_file(POPULATION_CSV, granularity))
+
+
+def has_data(granularity=REGION):
+    """Tells whether the data file of a granularity was downloaded.
+
+    Args:
+        granularity (str): a key of GRANULARITIES
 
     Returns:
-        pandas.Series: region, population density
+        bool: True if the data of the granularity can be read
     """
 
+    return os.path.isfile(os.path.basename(GRANULARITIES[granularity]["csv_url"]))
+
+
+def get_dens(granularity=REGION):
+    """Reads in an area-density Series.
+
+    The province table is written by get_provinces_data.
+
+    Args:
+        granularity (str): a key of GRANULARITIES
+
+    Returns:
+        pandas.Series: area, population density
+    """
+
+    if granularity != REGION:
+        return pd.read_csv(get_granularity_file(DENSITY_CSV, granularity), index_col=0, squeeze=True)
+
     try:
         dens = pd.read_csv(DENSITY_CSV, index_col=0, squeeze=True)
     except:
@@ -39,13 +110,21 @@ def get_dens():
     return dens
 
 
-def get_pop():
-    """Reads in a region-population Series.
+def get_pop(granularity=REGION):
+    """Reads in an area-population Series.
+
+    The province table is written by get_provinces_data.
+
+    Args:
+        granularity (str): a key of GRANULARITIES
 
     Returns:
-        pandas.Series: region, population
+        pandas.Series: area, population
     """
 
+    if granularity != REGION:
+        return pd.read_csv(get_granularity_file(POPULATION_CSV, granularity), index_col=0, squeeze=True)
+
     try:
         pop = pd.read_csv(POPULATION_CSV, index_col=0, squeeze=True)
     except:
@@ -90,6 +169,40 @@ def get_regions_data():
     write_pop(pop_dict)
 
 
+def get_provinces_data(filename="istat_data_province.csv", surface_filename="istat_superficie_province.csv"):
+    """For setup
+
+    Retrieves the province, population data and the province, surface data
+
+    Independent execution.
+    Replace filenames.
+
+    Args:
+        filename (str): population by province, in the format of the ISTAT regional data
+        surface_filename (str): csv with the province names ("Territorio") and surfaces in km2 ("Value")
+    """
+
+    # download from http://dati.istat.it/Index.aspx?DataSetCode=DCIS_POPRES1#, by province
+    # Match to data
+    replace_province_names = {
+        "Bolzano / Bozen": "Bolzano",
+        "Valle d'Aosta / Vallée d'Aoste": "Aosta",
+        "Massa-Carrara": "Massa Carrara",
+    }
+    csv_pop_df = pd.read_csv(filename)
+    pop = (
+        csv_pop_df[(csv_pop_df["Sesso"] == "totale") & (csv_pop_df["ETA1"] == "TOTAL")]
+        .set_index("Territorio", drop=True)["Value"]
+        .rename(index=replace_province_names)
+        .sort_index()
+    )
+    pop.to_frame("Population").to_csv(get_granularity_file(POPULATION_CSV, PROVINCE), index=True)
+
+    surface = pd.read_csv(surface_filename).set_index("Territorio", drop=True)["Value"]
+    dens = (pop / surface.rename(index=replace_province_names).reindex(pop.index)).round()
+    dens.to_frame("Density").to_csv(get_granularity_file(DENSITY_CSV, PROVINCE), index=True)
+
+
 def write_pop(pop_dict=None):
     """For setup
 
@@ -172,29 +285,283 @@ def write_dens(dens_dict=None):
     )
 
 
-def get_df(csv_url, download):
+def get_data_version(csv_url):
+    """Returns a version string for the local copy of the data.
+
+    The version changes whenever the file is rewritten, e.g. by a new download.
+
+    Args:
+        csv_url (str): url of csv file
+
+    Returns:
+        str: modification time and size of the local file
+    """
+
+    file_stat = os.stat(os.path.basename(csv_url))
+    version = f"{file_stat.st_mtime_ns}-{file_stat.st_size}"
+
+    return version
+
+
+def read_npz(file_name):
+    """Reads all the arrays of an npz file.
+
+    Args:
+        file_name (str): name of the npz file
+
+    Returns:
+        dict of (str, numpy.ndarray): the stored arrays, None if missing or unreadable
+    """
+
+    try:
+        with np.load(file_name) as npz_file:
+            arrays = {key: npz_file[key] for key in npz_file.files}
+    except (OSError, ValueError):
+        return None
+
+    return arrays
+
+
+def write_npz(file_name, arrays):
+    """Writes arrays to an npz file.
+
+    The file is written aside and renamed, so readers never see a partial file.
+
+    Args:
+        file_name (str): name of the npz file
+        arrays (dict of (str, numpy.ndarray)): the arrays to store
+    """
+
+    tmp_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(tmp_name, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_name, file_name)
+
+
+def get_snapshot_name(file_name):
+    """Returns the name of the binary snapshot of a data file.
+
+    Args:
+        file_name (str): name of the csv file
+
+    Returns:
+        str: name of the snapshot file
+    """
+
+    return os.path.splitext(file_name)[0] + SNAPSHOT_EXT
+
+
+def get_snapshot_dtype(column):
+    """Returns the type of a value column in the snapshot.
+
+    Daily values fit in float32. Cumulative ones are float64: float32 does not hold every integer above 2**24,
+    and the daily values differenced from them would be off by a few units.
+
+    Args:
+        column (str): value column
+
+    Returns:
+        numpy.dtype: float32 for the daily metrics, float64 for the cumulative and unknown ones
+    """
+
+    if column in DATA_METRICS and not DATA_METRICS[column]["cumulative"]:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def write_snapshot(cov_df, file_name, version, area_column=DENOMINAZIONE_REGIONE, columns=SNAPSHOT_COLUMNS):
+    """Writes a compact columnar copy of the data.
+
+    Only the columns used by the app are kept: typed dates, region names as category codes,
+    values as float32 for the daily metrics and float64 for the cumulative ones (tamponi, deceduti).
+
+    Args:
+        cov_df (pandas.DataFrame): data parsed from the csv file
+        file_name (str): name of the csv file
+        version (str): version of the csv file the snapshot is built from
+        area_column (str): names of the areas
+        columns (list of str): value columns to keep
+
+    Returns:
+        dict of (str, numpy.ndarray): the arrays written to the snapshot
+    """
+
+    regions = pd.Categorical(cov_df[area_column])
+    arrays = {
+        "version": np.array(version),
+        DATA: cov_df[DATA].values.astype("datetime64[ns]"),
+        "region_codes": regions.codes,
+        "region_names": np.array(regions.categories, dtype=str),
+    }
+    for column in columns:
+        arrays[column] = cov_df[column].values.astype(get_snapshot_dtype(column))
+
+    write_npz(get_snapshot_name(file_name), arrays)
+
+    return arrays
+
+
+def read_snapshot(file_name, version, columns=SNAPSHOT_COLUMNS):
+    """Reads the snapshot of a data file.
+
+    Args:
+        file_name (str): name of the csv file
+        version (str): current version of the csv file
+        columns (list of str): value columns the snapshot must have
+
+    Returns:
+        dict of (str, numpy.ndarray): the snapshot arrays, None if missing, incomplete, built from another version
+            or with other value types
+    """
+
+    arrays = read_npz(get_snapshot_name(file_name))
+    if arrays is None or str(arrays.get("version")) != version or not set(columns) <= set(arrays):
+        return None
+    if any(arrays[column].dtype != get_snapshot_dtype(column) for column in columns):
+        return None
+
+    return arrays
+
+
+def snapshot_to_df(arrays, area_column=DENOMINAZIONE_REGIONE, columns=SNAPSHOT_COLUMNS):
+    """Builds the vertical DataFrame out of the snapshot arrays.
+
+    Args:
+        arrays (dict of (str, numpy.ndarray)): snapshot arrays
+        area_column (str): names of the areas
+        columns (list of str): value columns to read
+
+    Returns:
+        pandas.DataFrame: data, area name and value columns
+    """
+
+    df_columns = {
+        DATA: arrays[DATA],
+        area_column: pd.Categorical.from_codes(arrays["region_codes"], arrays["region_names"]),
+    }
+    for column in columns:
+        df_columns[column] = arrays[column]
+
+    return pd.DataFrame(df_columns)
+
+
+@metrics.timed("download_csv")
+def download_csv(csv_url):
+    """Downloads the csv file if it changed on the server.
+
+    The validators of the last download (ETag, Last-Modified) are sent along with the request.
+    The body is streamed to a temporary file, which then replaces the local file in one rename.
+
+    Args:
+        csv_url (str): url of csv file
+
+    Returns:
+        bool: True if a new file was downloaded, False if the local file is up to date
+    """
+
+    file_name = os.path.basename(csv_url)
+    headers_name = file_name + DOWNLOAD_HEADERS_EXT
+
+    # Conditional request, only if there is a local file to keep
+    request_headers = {}
+    if os.path.isfile(file_name):
+        try:
+            with open(headers_name, "r") as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            validators = {}
+        if validators.get("etag"):
+            request_headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            request_headers["If-Modified-Since"] = validators["last_modified"]
+
+    with requests.get(csv_url, headers=request_headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as req:
+        if req.status_code == 304:  # Not modified
+            return False
+        req.raise_for_status()
+
+        tmp_name = f"{file_name}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_name, "wb") as csv_file:
+                for chunk in req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    csv_file.write(chunk)
+            os.replace(tmp_name, file_name)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+        validators = {"etag": req.headers.get("ETag"), "last_modified": req.headers.get("Last-Modified")}
+
+    with open(headers_name, "w") as f:
+        json.dump(validators, f)
+
+    return True
+
+
+def get_daily_cases(csv_df, area_column, cumulative_column):
+    """Differences the cumulative cases of each area to daily new cases.
+
+    Args:
+        csv_df (pandas.DataFrame): data parsed from the csv file, sorted by date
+        area_column (str): names of the areas
+        cumulative_column (str): cumulative cases
+
+    Returns:
+        pandas.Series: new cases, the cumulative value on the first day of each area
+    """
+
+    cumulative = csv_df[cumulative_column]
+
+    return cumulative.groupby(csv_df[area_column], sort=False).diff().fillna(cumulative)
+
+
+@metrics.timed("get_df")
+def get_df(csv_url, download, granularity=REGION):
     """Downloads or reads the data from file.
 
+    The csv file is only parsed once per version: a binary snapshot is written next to it and read afterwards.
+    The parsed data are also cached in memory and reused as long as the local file keeps the same version.
+    The returned DataFrame is shared between callers: do not modify it in place.
+
+    Areas missing from the population table are dropped, e.g. the provinces still being defined.
+
     Args:
         csv_url (str): url of csv file
-        download (bool): : True to download a new file
+        download (bool): : True to download a new file, if the data changed on the server
+        granularity (str): a key of GRANULARITIES, the granularity of the file
 
     Returns:
         DataFrame
     """
 
+    options = GRANULARITIES[granularity]
+
     file_name = os.path.basename(csv_url)
 
     # Download from Github
     if download:
-        req = requests.get(csv_url)
-        url_content = req.content
-        csv_file = open(file_name, "wb")
-        csv_file.write(url_content)
-        csv_file.close()
-
-    cov_df = pd.read_csv(file_name)
-    cov_df["data"] = pd.to_datetime(cov_df["data"])
+        download_csv(csv_url)
+
+    # Parse the file only if it changed since the last call
+    version = get_data_version(csv_url)
+    cached_version, cov_df = _df_cache.get(file_name, (None, None))
+    metrics.count("df", cached_version == version)
+    if cached_version != version:
+        arrays = read_snapshot(file_name, version, options["metrics"])
+        metrics.count("snapshot", arrays is not None)
+        if arrays is None:  # Missing or stale snapshot: parse the csv file
+            with metrics.span("parse_csv"):
+                csv_df = pd.read_csv(file_name)
+                csv_df[DATA] = pd.to_datetime(csv_df[DATA])
+                csv_df = csv_df[csv_df[options["area_column"]].isin(get_pop(granularity).index)]
+                if options["cumulative_column"] is not None:
+                    csv_df = csv_df.sort_values(DATA, kind="mergesort")
+                    csv_df[NUOVI_POSITIVI] = get_daily_cases(
+                        csv_df, options["area_column"], options["cumulative_column"]
+                    )
+            arrays = write_snapshot(csv_df, file_name, version, options["area_column"], options["metrics"])
+        cov_df = snapshot_to_df(arrays, options["area_column"], options["metrics"])
+        _df_cache[file_name] = (version, cov_df)
 
     return cov_df
-
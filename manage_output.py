@@ -1,49 +1,223 @@
 """Functions to plot the graphs and handle the html. """
+import contextlib
 import datetime
+import functools
+import hashlib
+import json
 import os
-import glob
 import pathlib
-import zlib
+import threading
 
+from constants import DATA_METRICS, GRANULARITIES, NUOVI_POSITIVI, REGION
+import image_store
+import manage_input
+import metrics
 
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import seaborn as sns
-sns.set()
+# Sorts of the heatmaps: name of the function in sort_regions, imported at the first sort
+sort_functions = {
+    "pca": "sort_by_pca",
+    "pop_density": "sort_by_pop_density",
+    "alphabetical": "sort_by_alphabetical",
+    "distance": "sort_by_distance",
+    "distance_initials": "sort_by_distance_initials",
+    "correlation": "sort_by_correlation",
+    "seriation": "sort_by_seriation",
+    "random": "sort_by_random",
+    "kmeans": "sort_by_kmeans",
+}
 
-from constants import IMAGES, CSV_URL
-import sort_regions
-import timeseries_funcs
+# Labels of the heatmap links, in the order they are shown
+heatmap_labels = {
+    "alphabetical": "Ordine alfabetico",
+    "pop_density": "Densità di popolazione",
+    "pca": "Similarità",
+    "seriation": "Seriazione",
+    "distance": "Distanza",
+    "distance_initials": "Distanza dalle prime",
+    "correlation": "Correlazione",
+    "kmeans": "K-means",
+    "random": "Casuale",
+}
 
-sort_functions = {
-    "pca": sort_regions.sort_by_pca,
-    "pop_density": sort_regions.sort_by_pop_density,
-    "alphabetical": sort_regions.sort_by_alphabetical,
+# Supported image formats: mime type and encoder settings
+image_formats = {
+    "png": {"mimetype": "image/png", "pil_kwargs": {"optimize": True}},
+    "webp": {"mimetype": "image/webp", "pil_kwargs": {"quality": 80, "method": 4}},
+    "svg": {"mimetype": "image/svg+xml"},
+    "jpg": {"mimetype": "image/jpeg", "pil_kwargs": {"quality": 85, "optimize": True}},
+}
+
+# Resolution presets of the images
+size_presets = {
+    "small": {"dpi": 60},
+    "normal": {"dpi": 100},
+    "large": {"dpi": 150},
+}
+
+# Everything that changes the look of a plot: part of its cache key
+plot_render_params = {
+    "renderer": 2,  # Increase when the plotting code changes
+    "figsize": [8, 12],
+    "format": "png",
+    "dpi": size_presets["normal"]["dpi"],
+}
+
+# Settings of the nightly images
+heatmap_render_params = {
+    "format": "jpg",
+    "dpi": size_presets["normal"]["dpi"],
 }
 
-'''
-NOT USED:
-"distance": sort_regions.sort_by_distance,
-"distance_initials": sort_regions.sort_by_distance_initials,
-"correlation": sort_regions.sort_by_correlation,
-"random": sort_regions.sort_by_random,
-"kmeans": sort_regions.sort_by_kmeans
-'''
+# Fixed margins of the plot figure, instead of computing a tight layout for each render
+plot_layout = {"left": 0.09, "right": 0.97, "bottom": 0.08, "top": 0.93, "hspace": 0.12}
+
+# Pre-laid-out plot figure, one for each thread
+_plot_template = threading.local()
 
 ########################################################################################################################
 # Functions used to handle the plots
 ########################################################################################################################
 
 
-def get_last_update():
-    """Returns the last update of the data file."""
+def get_last_update(granularity=REGION):
+    """Returns the last update of the data file of a granularity."""
 
-    filepath = pathlib.Path(os.path.basename(CSV_URL))
+    filepath = pathlib.Path(os.path.basename(GRANULARITIES[granularity]["csv_url"]))
     last_update = datetime.datetime.fromtimestamp(filepath.stat().st_mtime).strftime("%b %d %Y")
     return last_update
 
-def plot_graphs(pivot_regs, log_pivot_regs, suptitle, regions):
+@functools.lru_cache(maxsize=None)
+def get_seaborn():
+    """Imports seaborn and sets its style, at the first plot.
+
+    The plotting libraries are slow to import and only needed to draw: pages of cached plots never import them.
+
+    Returns:
+        module: seaborn
+    """
+
+    import seaborn as sns
+    sns.set()
+
+    return sns
+
+
+def get_sort_function(how):
+    """Returns a sort of the heatmaps, importing sort_regions at the first call.
+
+    Args:
+        how (str): a key of sort_functions
+
+    Returns:
+        function: the sort function
+    """
+
+    import sort_regions
+
+    return getattr(sort_regions, sort_functions[how])
+
+
+@contextlib.contextmanager
+def new_figure(**fig_kw):
+    """Yields a figure drawn by its own Agg canvas.
+
+    The figure is not registered in pyplot, so renders can run in parallel threads.
+    It is cleared on exit, even if the render fails.
+
+    Args:
+        fig_kw: arguments of matplotlib.figure.Figure
+    """
+
+    get_seaborn()  # Style of the figures
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(**fig_kw)
+    FigureCanvasAgg(fig)
+    try:
+        yield fig
+    finally:
+        fig.clear()
+
+
+@metrics.timed("save_figure")
+def save_figure(fig, filename, render_params, directory=None):
+    """Saves a figure to the images directory, through a temporary file.
+
+    Args:
+        fig (matplotlib.figure.Figure): the figure to save
+        filename (str): name of the image file
+        render_params (dict): format and dpi of the image
+        directory (str): unpublished directory to write to, the image store if None
+    """
+
+    image_format = render_params["format"]
+    savefig_kwargs = {"format": image_format, "dpi": render_params["dpi"]}
+    if "pil_kwargs" in image_formats[image_format]:
+        savefig_kwargs["pil_kwargs"] = image_formats[image_format]["pil_kwargs"]
+
+    if directory is not None:
+        fig.savefig(os.path.join(directory, filename), **savefig_kwargs)
+        return
+
+    tmp_path = image_store.get_tmp_path(filename)
+    fig.savefig(tmp_path, **savefig_kwargs)
+    image_store.store(tmp_path, filename)
+
+
+def get_render_params(image_format=None, size=None):
+    """Returns the render parameters of a plot.
+
+    Args:
+        image_format (str): a key of image_formats, the default format if None
+        size (str): a key of size_presets, the default size if None
+
+    Returns:
+        dict: render parameters, part of the cache key of the plot
+    """
+
+    render_params = dict(plot_render_params)
+    if image_format is not None:
+        render_params["format"] = image_format
+    if size is not None:
+        render_params["dpi"] = size_presets[size]["dpi"]
+
+    return render_params
+
+
+def negotiate_render_params(accept_mimetypes, image_format=None, size=None):
+    """Chooses the render parameters of a plot for a client.
+
+    An explicit format is used if supported. Otherwise WebP is used if the client explicitly accepts it, else PNG.
+
+    Args:
+        accept_mimetypes (werkzeug.datastructures.MIMEAccept): Accept header of the request
+        image_format (str): format requested by the client, if any
+        size (str): size preset requested by the client, if any
+
+    Returns:
+        dict: render parameters
+    """
+
+    if image_format not in image_formats:
+        explicit_mimetypes = set(accept_mimetypes.values())  # Not matched by wildcards
+        image_format = "webp" if image_formats["webp"]["mimetype"] in explicit_mimetypes else "png"
+    if size not in size_presets:
+        size = None
+
+    return get_render_params(image_format, size)
+
+
+def plot_graphs(
+    pivot_regs,
+    log_pivot_regs,
+    suptitle,
+    regions,
+    filename=None,
+    render_params=None,
+    granularity=REGION,
+    metric=NUOVI_POSITIVI,
+):
     """Plots two graphs: raw values and transformed values.
 
     Saves graphs to a file
@@ -52,40 +226,86 @@ def plot_graphs(pivot_regs, log_pivot_regs, suptitle, regions):
         log_pivot_regs (pandas.DataFrame): transformed values
         suptitle (str): title of the graph
         regions (list of str): regions to plot
+        filename (str): name of the image file, derived from the regions if None
+        render_params (dict): format and dpi of the image, plot_render_params if None
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+        metric (str): a key of DATA_METRICS, the plotted metric
+    """
+
+    if render_params is None:
+        render_params = plot_render_params
+    if filename is None:
+        filename = get_filename_from_regions(
+            regions, render_params=render_params, granularity=granularity, metric=metric
+        )  # Filenames are a function of the selected region
+
+    last_update = get_last_update(granularity)
+
+    # Only the lines, legends and titles change between two plots
+    with metrics.span("plot_layout"):
+        fig, ax1, ax2 = get_plot_template()
+        fig.suptitle(suptitle)
+        ax1.set_title(f"VALORI ASSOLUTI {DATA_METRICS[metric]['label'].upper()} (fino a: {last_update})")
+        set_plot_lines(ax1, pivot_regs)
+        set_plot_lines(ax2, log_pivot_regs)
+
+    save_figure(fig, filename, render_params)
+
+
+def get_plot_template():
+    """Returns the figure used by plot_graphs in this thread.
+
+    The figure is built at the first call: axes, grids, date ticks and margins are set once.
+
+    Returns:
+        (matplotlib.figure.Figure, matplotlib.axes.Axes, matplotlib.axes.Axes): figure, raw values axes, log axes
     """
 
-    filename = get_filename_from_regions(
-        regions
-    )  # Filenames are a function of the selected region
+    template = getattr(_plot_template, "figure", None)
+    if template is None:
+        get_seaborn()  # Style of the figures
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.dates import AutoDateFormatter, AutoDateLocator
+        from matplotlib.figure import Figure
 
-    last_update = get_last_update()
+        fig = Figure(figsize=plot_render_params["figsize"])
+        FigureCanvasAgg(fig)
+        ax1, ax2 = fig.subplots(2)
+        ax2.set_title("\nVALORI TRASFORMATI (proporzionali agli abitanti, scala log)")
+        for ax in (ax1, ax2):
+            ax.grid(True)
+            date_locator = AutoDateLocator()
+            ax.xaxis.set_major_locator(date_locator)
+            ax.xaxis.set_major_formatter(AutoDateFormatter(date_locator))
+        ax1.tick_params(axis="x", labelbottom=False)  # Dates below the lower plot only
+        fig.subplots_adjust(**plot_layout)
 
-    fig, (ax1, ax2) = plt.subplots(2, figsize=(8, 12))
-    fig.suptitle(suptitle)
+        template = (fig, ax1, ax2)
+        _plot_template.figure = template
 
-    ax1.plot(pivot_regs)
-    ax1.legend(pivot_regs.columns.values, loc="upper left")
-    ax1.set_title(f"VALORI ASSOLUTI NUOVI CONTAGI (fino a: {last_update})")
-    ax1.grid(True)
-    ax2.plot(log_pivot_regs)
-    ax2.legend(log_pivot_regs.columns.values, loc="upper left")
-    ax2.set_title("\nVALORI TRASFORMATI (proporzionali agli abitanti, scala log)")
-    ax2.grid(True)
-    fig.autofmt_xdate(rotation=-45, ha="left")
-    fig.tight_layout()
-    fig.savefig(os.path.join(IMAGES, filename))
+    return template
 
 
-def delete_images():
-    """Deletes all image files of the day.
+def set_plot_lines(ax, plot_regs):
+    """Replaces the lines and the legend of an axes.
 
-    Used by the scheduler.
+    Args:
+        ax (matplotlib.axes.Axes): axes of the plot template
+        plot_regs (pandas.DataFrame): values to plot, one line per column
     """
 
-    files = glob.glob(IMAGES + "/*")
-    for f in files:
-        print(f)
-        os.remove(f)
+    for line in list(ax.lines):
+        line.remove()
+    ax.relim()
+    ax.set_prop_cycle(None)  # The same colors for the same position
+
+    ax.plot(plot_regs)
+    ax.autoscale_view()
+    ax.legend(plot_regs.columns.values, loc="upper left")
+    for label in ax.get_xticklabels():
+        label.set_rotation(-45)
+        label.set_horizontalalignment("left")
+
 
 def plot_vert_lines(ax, x_coords, color):
     """ Plots vertical lines.
@@ -97,64 +317,100 @@ def plot_vert_lines(ax, x_coords, color):
     for c in x_coords:
         ax.axvline(c, color=color, linestyle="--", alpha=0.5)
 
-def build_heatmap(log_pivot_regs, how):
+def build_heatmap(log_pivot_regs, how, directory=None, granularity=REGION):
     """Builds a heatmap. Regions are sorted.
 
     Args:
         log_pivot_regs (pandas.DataFrame): Transformed values.
         how: A sorting algorithm among those listed in sort_functions dictionary
+        directory (str): directory of the nightly artifacts being built, the image store if None
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
     """
     log_pivot_regs = log_pivot_regs.copy()
 
     # Sort region names according to a selected function
-    ordered_list = sort_functions[how](log_pivot_regs.dropna())
+    ordered_list = get_sort_function(how)(log_pivot_regs.dropna(), granularity=granularity)
     log_pivot_regs.index = log_pivot_regs.index.strftime("%Y-%m-%d")
 
     select_log_pivot_regs = log_pivot_regs
     trans_log_pivot_regs = select_log_pivot_regs.T
     logs_ordered_by_dens = trans_log_pivot_regs.reindex(ordered_list)
 
-    # Add heatmap
-    sns.heatmap(logs_ordered_by_dens, cmap="RdYlGn_r")
+    with new_figure() as fig:
+        ax = fig.subplots()
+
+        # Add heatmap
+        get_seaborn().heatmap(logs_ordered_by_dens, cmap="RdYlGn_r", ax=ax)
 
-    # Set elements
-    plt.xlabel("Nuovi contagi giornalieri (log)")
-    plt.ylabel(f"Regioni ordinate: {how}")
-    plt.title("Heatmap", size=14)
-    plt.tight_layout()
+        # Set elements
+        ax.set_xlabel("Nuovi contagi giornalieri (log)")
+        ax.set_ylabel(f"Regioni ordinate: {how}")
+        ax.set_title("Heatmap", size=14)
+        fig.tight_layout()
 
-    filename = os.path.join(IMAGES, f"heatmap_{how}.jpg")
-    plt.savefig(filename)
-    plt.close()
+        save_figure(fig, get_heatmap_filename(how, granularity), heatmap_render_params, directory)
 
 
-def build_clustered_plot(log_pivot_regs):
+def build_clustered_plot(log_pivot_regs, directory=None, granularity=REGION):
     """Dtw clusters of regions, with peaks.
 
     Args:
         log_pivot_regs (pandas.DataFrame): Transformed values.
+        directory (str): directory of the nightly artifacts being built, the image store if None
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     """
 
+    from matplotlib.ticker import FixedLocator
+    import timeseries_funcs
+
     n_clusters = 3  # How many clusters to find
+    legend_lines = 21  # Area names that fit in the legend
+
+    clust_centers, cluster_labels, clust_peaks = timeseries_funcs.get_clusters(
+        log_pivot_regs, n_clusters=n_clusters, warm_start=True, granularity=granularity,
+        **GRANULARITIES[granularity]["dtw_params"]
+    )
+
+    with new_figure() as fig:
+        sns = get_seaborn()
+        ax = fig.subplots()
 
-    fig, ax = plt.subplots()
-    clust_centers, cluster_labels, clust_peaks = timeseries_funcs.get_clusters(log_pivot_regs, n_clusters=n_clusters)
+        ax.plot(clust_centers.T)  # Plot the clusterized areas
+        for n in range(n_clusters-1,-1,-1):  # Draw vertical lines at peaks
+            plot_vert_lines(ax, clust_peaks[n], sns.color_palette("pastel")[n])
 
-    ax.plot(clust_centers.T)  # Plot the clusterized areas
-    for n in range(n_clusters-1,-1,-1):  # Draw vertical lines at peaks
-        plot_vert_lines(ax, clust_peaks[n], sns.color_palette("pastel")[n])
+        legend_areas = len(log_pivot_regs.columns)  # Names listed for each cluster, the others are counted
+        if legend_areas > legend_lines:
+            legend_areas = legend_lines // n_clusters - 1
+        cluster_legends = [
+            "(" + ",\n".join(j[:legend_areas] + [f"+{len(j) - legend_areas}"] * (len(j) > legend_areas)) + ")"
+            for j in cluster_labels
+        ]
+        ax.legend(cluster_legends, bbox_to_anchor=(0, 1))  # Legend outside of plot area
 
-    cluster_legends = ["("+",\n".join(j)+")" for j in cluster_labels]
-    plt.legend(cluster_legends, bbox_to_anchor=(0, 1))  # Legend outside of plot area
+        ax.tick_params(axis='y', which='both', labelleft=False)  # Delete vertical tick labels
+        fig.autofmt_xdate(rotation=-60, ha="left")  # Horizontal labels small and rotated
+        ax.tick_params(colors=sns.color_palette()[0], labelsize="x-small")
+        ax.xaxis.set_major_locator(FixedLocator([p for p in clust_peaks[0]]))  # Horizontal labels only at peaks
 
-    ax.tick_params(axis='y', which='both', labelleft=False)  # Delete vertical tick labels
-    fig.autofmt_xdate(rotation=-60, ha="left")  # Horizontal labels small and rotated
-    ax.tick_params(colors=sns.color_palette()[0], labelsize="x-small")
-    ax.xaxis.set_major_locator(plt.FixedLocator([p for p in clust_peaks[0]]))  # Horizontal labels only at peaks
+        fig.tight_layout()
+        save_figure(fig, get_heatmap_filename("peaks_clusters", granularity), heatmap_render_params, directory)
 
-    fig.tight_layout()
-    fig.savefig(os.path.join(IMAGES, "peaks_clusters.jpg"))
+
+def get_heatmap_filename(how, granularity=REGION):
+    """Returns the file name of a nightly image.
+
+    Args:
+        how (str): a sorting algorithm among those listed in sort_functions, or "peaks_clusters"
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+
+    Returns:
+        str: the file name, with the extension of the heatmap format
+    """
+
+    name = how if how == "peaks_clusters" else f"heatmap_{how}"
+    return manage_input.get_granularity_file(f"{name}.{heatmap_render_params['format']}", granularity)
 
 
 ########################################################################################################################
@@ -176,13 +432,28 @@ def get_template():
     return html_template, css_template
 
 
+def get_chart_template():
+    """Returns the template for the web page drawn in the browser.
+
+    Returns:
+        str: template html
+    """
+
+    with open("chart_template.html", "r") as f:
+        html_template = f.read()
+    return html_template
+
+
 def get_full_page(
     html_template,
     css_template,
     plot_html="",
     error_message="",
     reg_options="",
-    heatmap_html=''
+    heatmap_html='',
+    heatmap_links='',
+    granularity=REGION,
+    metric_options="",
 ):
     """Returns a web page, complete with plot area and region names.
 
@@ -193,6 +464,9 @@ def get_full_page(
         error_message (str): html to show in case the input were wrong
         reg_options (str): html for the options of the multi choice box
         heatmap_html (str): html for the heatmap image
+        heatmap_links (str): html for the links switching the heatmap image
+        granularity (str): a key of GRANULARITIES, kept by the form
+        metric_options (str): html for the options of the metric choice box
 
     Returns:
         str: the complete web page
@@ -204,6 +478,9 @@ def get_full_page(
         error_message=error_message,
         reg_options=reg_options,
         heatmap_html=heatmap_html,
+        heatmap_links=heatmap_links,
+        granularity=granularity,
+        metric_options=metric_options,
     )
     return web_page
 
@@ -239,6 +516,66 @@ def get_heatmap_html(filename):
     return html_code.format(filename=filename)
 
 
+def get_series_payload(pivot_regs, log_pivot_regs, step=1, metric=NUOVI_POSITIVI):
+    """Returns the values of the regions, ready to be sent as JSON.
+
+    Args:
+        pivot_regs (pandas.DataFrame): raw data
+        log_pivot_regs (pandas.DataFrame): transformed values
+        step (int): keeps one day out of step, the last day is always kept
+        metric (str): a key of DATA_METRICS, the metric of the values
+
+    Returns:
+        dict: metric label, dates, regions, one list of values per region for raw and transformed data
+    """
+
+    pivot_regs = pivot_regs.iloc[(len(pivot_regs) - 1) % step::step]
+    log_pivot_regs = log_pivot_regs.reindex(pivot_regs.index)  # Missing days are null
+
+    def to_lists(df, decimals):
+        values = df.T.round(decimals).astype(object)
+        return values.where(values.notnull(), None).values.tolist()
+
+    payload = {
+        "metric": DATA_METRICS[metric]["label"],
+        "dates": list(pivot_regs.index.strftime("%Y-%m-%d")),
+        "regions": list(pivot_regs.columns),
+        "raw": to_lists(pivot_regs, 0),
+        "log": to_lists(log_pivot_regs, 4),
+    }
+
+    return payload
+
+
+def get_heatmap_links(artifacts_path="", granularity=REGION):
+    """Returns the links switching the heatmap image.
+
+    Args:
+        artifacts_path (str): path of the published artifacts, relative to the static directory
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+
+    Returns:
+        str: html for the links, one for each heatmap and one for the cluster plot
+    """
+
+    link_template = (
+        '<a onclick="document.getElementById(\'heatmap-img\').src=\'/static/{filename}\';" '
+        'href="javascript:void(0);">{label}</a>'
+    )
+
+    def get_url_path(how):
+        return "/".join(filter(None, [artifacts_path, get_heatmap_filename(how, granularity)]))
+
+    links = [
+        link_template.format(filename=get_url_path(how), label=label)
+        for how, label in heatmap_labels.items()
+        if how in sort_functions
+    ]
+    links.append(link_template.format(filename=get_url_path("peaks_clusters"), label="Cluster e picchi"))
+
+    return " |\n".join(links)
+
+
 def incorrect_input_message():
     """Adds an error message to the page.
 
@@ -250,6 +587,17 @@ def incorrect_input_message():
     return html_code
 
 
+def heatmaps_not_built_message():
+    """Replaces the heatmaps in the page until they are built.
+
+    Returns:
+        str: html to show in place of the heatmaps
+    """
+
+    html_code = "<br><p>The heatmaps are not built yet. Please come back later</p><br>"
+    return html_code
+
+
 def get_reg_options(regions, pop):
     """Builds the options of a multi choice box
 
@@ -278,19 +626,76 @@ def get_reg_options(regions, pop):
     return html_code
 
 
-def get_filename_from_regions(regions):
+def get_metric_options(metric, granularity=REGION):
+    """Builds the options of the metric choice box.
+
+    Args:
+        metric (str): the metric to pre-select
+        granularity (str): a key of GRANULARITIES, whose metrics are listed
+
+    Returns:
+        str: html for the options of the choice box
+    """
+
+    option_template = '<option value="{name}"{selected}>{label}</option>'
+
+    option_list = [
+        option_template.format(name=name, selected=" selected" * (name == metric), label=DATA_METRICS[name]["label"])
+        for name in GRANULARITIES[granularity]["metrics"]
+    ]
+
+    return "\n".join(option_list)
+
+
+def canonical_regions(regions):
+    """Returns the regions in a canonical order, without duplicates.
+
+    Args:
+        regions (list of str): the selected regions
+
+    Returns:
+        list of str: sorted regions
+    """
+
+    return sorted(set(regions))
+
+
+def get_filename_from_regions(
+    regions, data_version=None, render_params=None, granularity=REGION, metric=NUOVI_POSITIVI
+):
     """Returns a filename for the plot.
 
-    The file name is a hash of the input strings.
+    The file name is a hash of the selected regions, regardless of their order,
+    of the version of the data, of the render parameters, of the granularity and of the metric.
 
     Args:
         regions (list of str): the selected regions
+        data_version (str): version of the data, the current one if None
+        render_params (dict): parameters of the plot, plot_render_params if None
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+        metric (str): a key of DATA_METRICS, the plotted metric
 
     Returns:
         str: the file name for the chosen inputs
     """
 
-    filename_checksum = zlib.adler32("".join(regions).encode("utf-8"))
-    filename = str(filename_checksum) + ".png"
+    if data_version is None:
+        data_version = manage_input.get_data_version(GRANULARITIES[granularity]["csv_url"])
+    if render_params is None:
+        render_params = plot_render_params
+
+    cache_key = json.dumps(
+        {
+            "regions": canonical_regions(regions),
+            "data_version": data_version,
+            "render": render_params,
+            "granularity": granularity,
+            "metric": metric,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    filename_checksum = hashlib.sha256(cache_key.encode("utf-8")).hexdigest()[:32]
+    filename = f"{filename_checksum}.{render_params['format']}"
 
     return filename
@@ -0,0 +1,190 @@
+"""Timing spans, cache counters and events of this process, exposed in the Prometheus text format.
+
+Off unless COVCOMPARE_METRICS is set: spans are then a shared no-op and decorated functions are not wrapped.
+Each process keeps its own values, so every worker must be scraped.
+"""
+import bisect
+import functools
+import threading
+import time
+
+from constants import METRICS_BUCKETS, METRICS_ENABLED
+import image_store
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Stage: counts per bucket (the last one for +Inf), total seconds, count
+_histograms = {}
+# (cache, result): count
+_counters = {}
+# (event, subject): count
+_events = {}
+_lock = threading.Lock()
+
+
+class _NoSpan:
+    """Context manager doing nothing, returned by span when the metrics are off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+class _Span:
+    """Context manager timing a block of a stage."""
+
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+def span(stage):
+    """Returns a context manager timing a block, failed blocks included.
+
+    Args:
+        stage (str): name of the stage in the histograms
+
+    Returns:
+        context manager
+    """
+
+    return _Span(stage) if METRICS_ENABLED else _no_span
+
+
+def timed(stage):
+    """Decorator timing each call of a function. The function is returned as it is when the metrics are off.
+
+    Args:
+        stage (str): name of the stage in the histograms
+    """
+
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe(stage, seconds):
+    """Adds a duration to the histogram of a stage.
+
+    Args:
+        stage (str): name of the stage
+        seconds (float): duration
+    """
+
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [[0] * (len(METRICS_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+def count(cache, hit):
+    """Counts a hit or a miss of a cache.
+
+    Args:
+        cache (str): name of the cache
+        hit (bool): True if the cached value was used
+    """
+
+    if not METRICS_ENABLED:
+        return
+    key = (cache, "hit" if hit else "miss")
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + 1
+
+
+def report(event, subject):
+    """Counts an event to be alerted on, such as an operation over its budget.
+
+    Args:
+        event (str): kind of event
+        subject (str): the operation or data it happened to
+    """
+
+    if not METRICS_ENABLED:
+        return
+    key = (event, subject)
+    with _lock:
+        _events[key] = _events.get(key, 0) + 1
+
+
+def get_label(value):
+    """Escapes a label value."""
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """Returns the metrics in the Prometheus text format.
+
+    Returns:
+        str: the exposition text
+    """
+
+    with _lock:
+        histograms = {stage: (list(buckets), total, n) for stage, (buckets, total, n) in _histograms.items()}
+        counters = dict(_counters)
+        events = dict(_events)
+
+    lines = [
+        "# HELP covcompare_stage_seconds Duration of the stages of the requests and of the scheduled operations.",
+        "# TYPE covcompare_stage_seconds histogram",
+    ]
+    for stage, (buckets, total, n) in sorted(histograms.items()):
+        label = get_label(stage)
+        cumulative = 0
+        for bound, bucket_count in zip(list(METRICS_BUCKETS) + ["+Inf"], buckets):
+            cumulative += bucket_count
+            lines.append(f'covcompare_stage_seconds_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'covcompare_stage_seconds_sum{{stage="{label}"}} {total:.6f}')
+        lines.append(f'covcompare_stage_seconds_count{{stage="{label}"}} {n}')
+
+    lines += [
+        "# HELP covcompare_cache_total Lookups of the in-memory and on-disk caches.",
+        "# TYPE covcompare_cache_total counter",
+    ]
+    for (cache, result), value in sorted(counters.items()):
+        lines.append(f'covcompare_cache_total{{cache="{get_label(cache)}",result="{result}"}} {value}')
+
+    lines += [
+        "# HELP covcompare_events_total Budget overruns and other events to be alerted on.",
+        "# TYPE covcompare_events_total counter",
+    ]
+    for (event, subject), value in sorted(events.items()):
+        lines.append(f'covcompare_events_total{{event="{get_label(event)}",subject="{get_label(subject)}"}} {value}')
+
+    lines += [
+        "# HELP covcompare_image_store_total Plot lookups and evictions of the image store.",
+        "# TYPE covcompare_image_store_total counter",
+    ]
+    for event, value in sorted(image_store.get_stats().items()):
+        lines.append(f'covcompare_image_store_total{{event="{event}"}} {value}')
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+"""On-demand profiling of a page request or of a scheduled run.
+
+A profiled run writes to PROFILE_DIR, under a name made of its time, process and function:
+- .pstats: cProfile statistics, to be read with pstats or snakeviz
+- .collapsed: stacks sampled every PROFILE_INTERVAL, one "frame;frame;... count" line each, for flamegraph.pl or speedscope
+Only the PROFILE_KEEP most recent runs are kept.
+
+Usage: python profiling.py [mode] [seconds], prints the query arguments profiling a request for the next seconds.
+"""
+import contextlib
+import cProfile
+import datetime
+import glob
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+
+from constants import PROFILE_DIR, PROFILE_INTERVAL, PROFILE_KEEP, PROFILE_KEY, PROFILE_MODE
+
+MODES = ("cprofile", "sampling", "all")
+
+
+def get_env_mode():
+    """Returns the profiling mode set by COVCOMPARE_PROFILE, None if unset: 1 stands for all."""
+
+    if PROFILE_MODE in ("", "0"):
+        return None
+
+    return PROFILE_MODE if PROFILE_MODE in MODES else "all"
+
+
+def get_signature(mode, expires, key=PROFILE_KEY):
+    """Returns the signature of a profiling request.
+
+    Args:
+        mode (str): one of MODES
+        expires (int): unix time after which the signature is refused
+        key (str): secret key
+
+    Returns:
+        str: hex HMAC-SHA256 of the mode and expiry
+    """
+
+    return hmac.new(key.encode("utf-8"), f"{mode}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def get_request_mode(args):
+    """Returns the profiling mode of a request.
+
+    The profile, expires and signature arguments are checked against PROFILE_KEY: requests without a valid,
+    unexpired signature are not profiled, and are served as usual.
+
+    Args:
+        args (dict of (str, str)): query arguments of the request
+
+    Returns:
+        str: one of MODES, None if the request is not to be profiled
+    """
+
+    env_mode = get_env_mode()
+    if env_mode is not None:
+        return env_mode
+
+    mode = args.get("profile")
+    if mode not in MODES or not PROFILE_KEY:
+        return None
+    try:
+        expires = int(args.get("expires", ""))
+    except ValueError:
+        return None
+    if expires < time.time() or not hmac.compare_digest(get_signature(mode, expires), args.get("signature", "")):
+        return None
+
+    return mode
+
+
+def get_frame_name(frame):
+    """Returns the name of a frame in the collapsed stacks: function (file:line), without semicolons."""
+
+    code = frame.f_code
+    name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    return name.replace(";", ",")
+
+
+def sample_stacks(thread_id, stop, stacks, interval=PROFILE_INTERVAL):
+    """Counts the stacks of a thread, until stop is set.
+
+    Args:
+        thread_id (int): identifier of the sampled thread
+        stop (threading.Event): set when the profiled run ends
+        stacks (dict of (str, int)): collapsed stack, samples; updated in place
+        interval (float): seconds between two samples
+    """
+
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            names.append(get_frame_name(frame))
+            frame = frame.f_back
+        if names:
+            stack = ";".join(reversed(names))
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+
+def rotate(directory=PROFILE_DIR, keep=PROFILE_KEEP):
+    """Deletes the files of the oldest profiled runs, keeping the most recent ones.
+
+    Args:
+        directory (str): directory of the profiles
+        keep (int): runs to keep
+    """
+
+    runs = sorted({os.path.splitext(path)[0] for path in glob.glob(os.path.join(directory, "*.*"))})
+    for run in runs[:max(len(runs) - keep, 0)]:
+        for path in glob.glob(glob.escape(run) + ".*"):
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+
+@contextlib.contextmanager
+def profile(name, mode, directory=PROFILE_DIR):
+    """Profiles the block, in the calling thread, and writes the results.
+
+    Args:
+        name (str): name of the profiled function, part of the file names
+        mode (str): one of MODES
+        directory (str): directory of the profiles
+
+    Yields:
+        str: path of the results, without the extension
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    run = os.path.join(directory, f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}-{name}")
+
+    profiler = cProfile.Profile() if mode in ("cprofile", "all") else None
+    stacks = {}
+    stop = threading.Event()
+    sampler = None
+    if mode in ("sampling", "all"):
+        sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), stop, stacks), daemon=True)
+        sampler.start()
+
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield run
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(f"{run}.pstats")
+        if sampler is not None:
+            stop.set()
+            sampler.join()
+            with open(f"{run}.collapsed", "w") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+        rotate(directory)
+
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "all"
+    expires = int(time.time()) + (int(sys.argv[2]) if len(sys.argv) > 2 else 600)
+    if not PROFILE_KEY:
+        sys.exit("COVCOMPARE_PROFILE_KEY is not set")
+    print(f"profile={mode}&expires={expires}&signature={get_signature(mode, expires)}")
@@ -3,107 +3,147 @@ import random
 
 import numpy as np
 import pandas as pd
-from scipy.spatial import distance
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
 
-from constants import LOMBARDIA
+from constants import GRANULARITIES, REGION
+import distances
 import manage_input
 
 
-def sort_by_correlation(log_pivot_regs):
+def get_start_index(columns, granularity=REGION):
+    """Returns the position of the first region of the greedy sorts: the bench area, or the first one if missing.
+
+    Args:
+        columns (pandas.Index): the regions
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+
+    Returns:
+        int: position of the first region
+    """
+
+    bench_area = GRANULARITIES[granularity]["bench_area"]
+
+    return columns.get_loc(bench_area) if bench_area in columns else 0
+
+
+def greedy_sort(dists, start, n_neighbors=5, initials=False):
+    """Each region is the closest to n_neighbors already sorted ones.
+
+    The closest region has the lowest l2 norm of its distances from the reference regions.
+    Sorted regions are masked instead of removed, each step is a single argmin.
+
+    Args:
+        dists (numpy.ndarray): (n.regions * n.regions) distances
+        start (int): position of the first region
+        n_neighbors (int): how many sorted regions are the reference
+        initials (bool): True for the first sorted regions as the reference, False for the last ones
+
+    Returns:
+        numpy.ndarray: positions of the sorted regions
+    """
+
+    n_regions = len(dists)
+    order = np.empty(n_regions, dtype=int)
+    remaining = np.ones(n_regions, dtype=bool)
+
+    order[0] = start
+    remaining[start] = False
+    for i in range(1, n_regions):
+        reference = order[:n_neighbors] if initials else order[max(i - n_neighbors, 0):i]
+        sq_norms = np.square(dists[:, reference[:i]]).sum(axis=1)
+        selected = np.where(remaining, sq_norms, np.inf).argmin()  # Select the lowest l2 norm
+        order[i] = selected
+        remaining[selected] = False
+
+    return order
+
+
+def sort_by_correlation(log_pivot_regs, granularity=REGION):
     """Each region is the most correlated with the preceding one.
 
     Args:
         log_pivot_regs (pandas.DataFrame):  The data (n.days * n.regions), without NaN values
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
         list: A list of sorted regions
     """
-    corr_regs = log_pivot_regs.corr(method="spearman")
-    reg_list = list(corr_regs.columns)
-
-    ordered_list = []
-    selected = LOMBARDIA
-    while len(reg_list) > 1:  # Find the next best correlated region
-        ordered_list.append(selected)
-        reg_list.remove(selected)
-        selected = corr_regs.loc[reg_list, selected].idxmax()
-    ordered_list.append(selected)
-    return ordered_list
+    corr_regs = distances.get_distances(log_pivot_regs, "spearman", granularity=granularity)
+    corrs = np.nan_to_num(corr_regs.values, nan=-np.inf)
+
+    n_regions = len(corrs)
+    order = np.empty(n_regions, dtype=int)
+    remaining = np.ones(n_regions, dtype=bool)
+
+    selected = get_start_index(corr_regs.columns, granularity)
+    order[0] = selected
+    remaining[selected] = False
+    for i in range(1, n_regions):  # Find the next best correlated region
+        selected = np.where(remaining, corrs[:, selected], -np.inf).argmax()
+        order[i] = selected
+        remaining[selected] = False
 
+    return list(corr_regs.columns[order])
 
-def sort_by_distance(log_pivot_regs):
+
+def sort_by_distance(log_pivot_regs, granularity=REGION):
     """Each region is the closest to the 5 preceding one, using euclidean distances.
 
     Args:
         log_pivot_regs (pandas.DataFrame):  The data (n.days * n.regions), without NaN values
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
         list: A list of sorted regions
     """
 
-    reg_list = list(log_pivot_regs.columns)
-    ordered_list = []
-
-    selected = LOMBARDIA
-    while (
-        len(reg_list) > 1
-    ):  # Find the next region, whose distance is the closest to the preceding 5 distances
-        ordered_list.append(selected)
-        reg_list.remove(selected)
-        to_sort = log_pivot_regs.loc[:, reg_list]
-        already_sorted = log_pivot_regs.loc[:, ordered_list[-5:]]
-        dists = distance.cdist(
-            to_sort.T, already_sorted.T
-        )  # Euclidean distances between already sorted and candidates
-        meandists = np.linalg.norm(
-            dists, axis=1
-        )  # l2 norm for the region distance vectors
-        mindist = meandists.argmin()  # Select the lowest l2 norm
-        selected = to_sort.columns[mindist]
-
-    ordered_list.append(selected)
+    dists_regs = distances.get_distances(log_pivot_regs, "euclidean", granularity=granularity)
+    order = greedy_sort(dists_regs.values, get_start_index(dists_regs.columns, granularity))
 
-    return ordered_list
+    return list(dists_regs.columns[order])
 
 
-def sort_by_distance_initials(log_pivot_regs):
+def sort_by_distance_initials(log_pivot_regs, granularity=REGION):
     """Each region is the closest to the top 5 regions.
 
     Args:
         log_pivot_regs (pandas.DataFrame):  The data (n.days * n.regions), without NaN values
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
         list: A list of sorted regions
     """
-    reg_list = list(log_pivot_regs.columns)
-    ordered_list = []
-
-    # Order regions by distance from the preceding 5 distances
-    selected = LOMBARDIA
-    while (
-        len(reg_list) > 1
-    ):  # Find the next region, whose distance is the closest to the top 5 distances
-        ordered_list.append(selected)
-        reg_list.remove(selected)
-        to_sort = log_pivot_regs.loc[:, reg_list]
-        already_sorted = log_pivot_regs.loc[:, ordered_list[:5]]
-        dists = distance.cdist(
-            to_sort.T, already_sorted.T
-        )  # Euclidean distances between top sorted and candidates
-        meandists = np.linalg.norm(
-            dists, axis=1
-        )  # l2 norm for the region distance vectors
-        mindist = meandists.argmin()  # Select the lowest l2 norm
-        selected = to_sort.columns[mindist]
-
-    ordered_list.append(selected)
 
-    return ordered_list
+    dists_regs = distances.get_distances(log_pivot_regs, "euclidean", granularity=granularity)
+    order = greedy_sort(dists_regs.values, get_start_index(dists_regs.columns, granularity), initials=True)
+
+    return list(dists_regs.columns[order])
+
+
+def sort_by_seriation(log_pivot_regs, granularity=REGION):
+    """Similar regions are adjacent: the leaves of a hierarchical clustering, in optimal order.
+
+    The optimal leaf ordering minimizes the sum of the euclidean distances between adjacent regions.
+
+    Args:
+        log_pivot_regs (pandas.DataFrame):  The data (n.days * n.regions), without NaN values
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+
+    Returns:
+        list: A list of sorted regions
+    """
+
+    dists_regs = distances.get_distances(log_pivot_regs, "euclidean", granularity=granularity)
+    condensed = squareform(dists_regs.values, checks=False)
+    tree = hierarchy.optimal_leaf_ordering(hierarchy.linkage(condensed, method="average"), condensed)
+
+    return list(dists_regs.columns[hierarchy.leaves_list(tree)])
 
 
-def sort_by_kmeans(log_pivot_regs):
+def sort_by_kmeans(log_pivot_regs, granularity=REGION):
     """Two K-means clusters identify a direction for placing the regions.
 
     The regions are clustered to two representative sets.
@@ -113,6 +153,7 @@ def sort_by_kmeans(log_pivot_regs):
 
     Args:
         log_pivot_regs (pandas.DataFrame):  The data (n.days * n.regions), without NaN values
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
         list: A list of sorted regions
@@ -131,11 +172,12 @@ def sort_by_kmeans(log_pivot_regs):
     return ordered_list
 
 
-def sort_by_pca(log_pivot_regs):
+def sort_by_pca(log_pivot_regs, granularity=REGION):
     """Pca reduces all the daily variations to a single dimension, which is used to sort the regions.
 
     Args:
         log_pivot_regs (pandas.DataFrame) : The data (n.days * n.regions), without NaN values
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
         list: A list of sorted regions
@@ -151,27 +193,29 @@ def sort_by_pca(log_pivot_regs):
     return ordered_list
 
 
-def sort_by_pop_density(*args):
+def sort_by_pop_density(*args, granularity=REGION):
     """The regions with the heghest population density come first.
 
     Args:
         args: Ensures a compatible function signature
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
         list: A list of sorted regions
     """
 
-    pop_density = manage_input.get_dens()
+    pop_density = manage_input.get_dens(granularity)
     ordered_list = pop_density.sort_values(ascending=False).index
 
     return ordered_list
 
 
-def sort_by_random(log_pivot_regs):
-    """The regions with the highest population density come first.
+def sort_by_random(log_pivot_regs, granularity=REGION):
+    """The regions are shuffled.
 
     Args:
         log_pivot_regs (pandas.DataFrame) : The data (n.days * n.regions), without NaN values
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
         list: A list of sorted regions
@@ -182,11 +226,12 @@ def sort_by_random(log_pivot_regs):
     return ordered_list
 
 
-def sort_by_alphabetical(log_pivot_regs):
+def sort_by_alphabetical(log_pivot_regs, granularity=REGION):
     """Alphabetical sorting of the regions.
 
     Args:
         log_pivot_regs (pandas.DataFrame):  The data (n.days * n.regions), without NaN values
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
         list: A list of sorted regions
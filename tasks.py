@@ -1,13 +1,32 @@
 """ The top-level functions."""
 
+import concurrent.futures
 import os
+import shutil
+import time
 
 import numpy as np
 
-from constants import CSV_URL, DEFAULT_START, IMAGES
+from constants import (
+    ARTIFACTS,
+    CSV_URL,
+    DEFAULT_START,
+    GRANULARITIES,
+    IMAGES,
+    NIGHTLY_BUDGET,
+    NIGHTLY_GRANULARITIES,
+    NIGHTLY_WORKERS,
+    NUOVI_POSITIVI,
+    PAGE_BUDGET,
+    REGION,
+)
+import distances
+import image_store
 import manage_app
 import manage_input
 import manage_output
+import metrics
+import profiling
 
 
 def compare_ita_vs_region(region, download, pop):
@@ -42,25 +61,119 @@ def compare_ita_vs_region(region, download, pop):
     )
 
 
-def scheduled_reset_operations(download):
-    """Performs the end-of-day scheduled operations.
+@metrics.timed("scheduled_reset_operations")
+def scheduled_reset_operations(download, incremental=True):
+    """Performs the end-of-day scheduled operations, one run at a time.
+
+    If COVCOMPARE_PROFILE is set the run is profiled, its tasks are then run in this process.
+
+    Args:
+        download (bool): True to download a new csv file.
+        incremental (bool): False to transform the whole history again.
+    """
+
+    mode = profiling.get_env_mode()
+    with image_store.reset_lock():
+        if mode is None:
+            run_reset_operations(download, incremental=incremental)
+        else:
+            with profiling.profile("scheduled_reset_operations", mode):
+                run_reset_operations(download, incremental=incremental, in_process=True)
+
+
+def get_nightly_granularities():
+    """Returns the granularities built by the scheduled operations: those with a population table.
+
+    The others are counted in the skipped_granularity events of the metrics.
+
+    Returns:
+        list of str: keys of GRANULARITIES
+    """
+
+    granularities = []
+    for granularity in NIGHTLY_GRANULARITIES:
+        if manage_input.has_population(granularity):
+            granularities.append(granularity)
+        else:
+            # No population table, see manage_input.get_provinces_data
+            metrics.report("skipped_granularity", granularity)
+
+    return granularities
 
-    - Downloads the data
-    - Deletes the old plots
-    - Finds the default inputs
+
+def check_budget(name, elapsed, budget):
+    """Counts an operation that took longer than its budget, in the over_budget events of the metrics.
+
+    Args:
+        name (str): the operation
+        elapsed (float): seconds it took
+        budget (float): seconds it may take
     """
 
-    # Download new
-    cov_df = manage_input.get_df(CSV_URL, download=download)
-    pop = manage_input.get_pop()
-    # Reset plots
-    manage_output.delete_images()
+    if elapsed > budget:
+        metrics.report("over_budget", name)
 
-    # Pivot all data
-    pivot_regs, log_pivot_regs = manage_app.get_raw_log_data(cov_df, pop.index, pop)
 
-    # Build heatmaps
-    generate_all_heatmaps(log_pivot_regs)
+def run_reset_operations(download, incremental=True, in_process=False):
+    """Performs the end-of-day scheduled operations.
+
+    - Downloads the data of each granularity, stops if they did not change
+    - Updates the stored all-regions data
+    - Builds a new version of the heatmaps, finds the default inputs
+    - Publishes the new version in one step
+
+    Plots of the old data are not deleted: they are never requested again and the image store evicts them.
+
+    Args:
+        download (bool): True to download a new csv file.
+        incremental (bool): False to transform the whole history again.
+        in_process (bool): True to run the tasks in this process, one at a time
+    """
+
+    t0 = time.perf_counter()
+    granularities = get_nightly_granularities()
+
+    # Download new, nothing to do if the data did not change
+    if download:
+        with metrics.span("download"):
+            modified = [
+                manage_input.download_csv(GRANULARITIES[granularity]["csv_url"]) for granularity in granularities
+            ]
+        if not any(modified) and image_store.get_artifacts_version() is not None:
+            print("Data not modified")
+            return
+
+    build_dir = image_store.new_artifacts_dir()
+    try:
+        # Pivot all data
+        graph = {}
+        for granularity in granularities:
+            csv_url = GRANULARITIES[granularity]["csv_url"]
+            cov_df = manage_input.get_df(csv_url, download=False, granularity=granularity)
+            pop = manage_input.get_pop(granularity)
+            pivot_regs, log_pivot_regs = manage_app.update_all_raw_log_data(
+                cov_df, pop, incremental=incremental, granularity=granularity
+            )
+            graph.update(get_heatmap_graph(log_pivot_regs.dropna(), build_dir, granularity))
+
+        # Build heatmaps of all granularities, choose the default inputs: the published version is served meanwhile
+        run_task_graph(graph, in_process=in_process)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    image_store.publish_artifacts(build_dir)
+
+    check_budget("scheduled operations", time.perf_counter() - t0, NIGHTLY_BUDGET)
+
+
+def write_default_start(log_pivot_regs, directory=None, granularity=REGION):
+    """Writes the regions of the default page: lowest and highest last value.
+
+    Args:
+        log_pivot_regs (pandas.DataFrame) : The data
+        directory (str): directory of the nightly artifacts being built, the project directory if None
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+    """
 
     # Choose max min
     last_day_log = log_pivot_regs.iloc[-1:]
@@ -68,12 +181,14 @@ def scheduled_reset_operations(download):
     max_region = last_day_log.idxmax(axis=1)[0]
 
     # Write the default start file
-    with open(DEFAULT_START, "w") as f:
+    default_start = manage_input.get_granularity_file(DEFAULT_START, granularity)
+    with open(default_start if directory is None else os.path.join(directory, default_start), "w") as f:
         f.write(min_region + "\n")
         f.write(max_region)
 
 
-def build_page(error_message, filename, regions, pop, heatmap_filename):
+@metrics.timed("build_page")
+def build_page(error_message, filename, regions, pop, heatmap_filename, granularity=REGION, metric=NUOVI_POSITIVI):
     """Builds a complete webpage.
 
     Prepares the content and fills the template in.
@@ -85,7 +200,9 @@ def build_page(error_message, filename, regions, pop, heatmap_filename):
         error_message (str): Message to display on top of the page.
 
     Kwargs:
-        heatmap_filename: File for the heatmap plot.
+        heatmap_filename: File for the heatmap plot, None if the heatmaps are not built yet.
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+        metric (str): a key of DATA_METRICS, the selected metric
 
     Returns:
         str: The Html web page.
@@ -100,9 +217,17 @@ def build_page(error_message, filename, regions, pop, heatmap_filename):
         filename=filename, regions=regions
     )  # Get plot area
 
-    heatmap_html = manage_output.get_heatmap_html(
-        filename=heatmap_filename
-    )  # Get heatmap area
+    if heatmap_filename is None:
+        heatmap_html = manage_output.heatmaps_not_built_message()  # Until the scheduled operations publish them
+        heatmap_links = ""
+    else:
+        heatmap_html = manage_output.get_heatmap_html(
+            filename=heatmap_filename
+        )  # Get heatmap area
+
+        heatmap_links = manage_output.get_heatmap_links(
+            artifacts_path=os.path.dirname(heatmap_filename), granularity=granularity
+        )  # Get the links to the other heatmaps
 
     reg_options = manage_output.get_reg_options(
         regions=regions, pop=pop
@@ -115,59 +240,236 @@ def build_page(error_message, filename, regions, pop, heatmap_filename):
         error_message=error_message,
         reg_options=reg_options,
         heatmap_html=heatmap_html,
+        heatmap_links=heatmap_links,
+        granularity=granularity,
+        metric_options=manage_output.get_metric_options(metric, granularity),
     )
     return return_page
 
 
-def get_plot_file(regions, pop):
+def get_series(regions, pop, step, granularity=REGION, metric=NUOVI_POSITIVI):
+    """Returns the values of the selected regions, for client-side charts.
+
+    Args:
+        regions (list): the selected regions
+        pop (dict): region, population
+        step (int): keeps one day out of step
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+        metric (str): a key of DATA_METRICS, the selected metric
+
+    Returns:
+        dict: metric label, dates, regions, raw and transformed values
+    """
+
+    regions = manage_output.canonical_regions(regions)
+    cov_df = manage_input.get_df(GRANULARITIES[granularity]["csv_url"], download=False, granularity=granularity)
+    pivot_regs, log_pivot_regs = manage_app.get_raw_log_data(cov_df, regions, pop, granularity, metric)
+
+    return manage_output.get_series_payload(pivot_regs, log_pivot_regs, step, metric)
+
+
+def build_chart_page(regions, pop, step, granularity=REGION, metric=NUOVI_POSITIVI):
+    """Builds the webpage whose charts are drawn in the browser.
+
+    Args:
+        regions (list): the regions selected at first
+        pop (dict): region, population
+        step (int): keeps one day out of step
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+        metric (str): a key of DATA_METRICS, the metric selected at first
+
+    Returns:
+        str: The Html web page.
+    """
+
+    html_template = manage_output.get_chart_template()
+    _, css_template = manage_output.get_template()
+    reg_options = manage_output.get_reg_options(regions=regions, pop=pop)
+
+    return html_template.format(
+        css=css_template,
+        reg_options=reg_options,
+        data_url="/data",
+        step=step,
+        granularity=granularity,
+        metric_options=manage_output.get_metric_options(metric, granularity),
+    )
+
+
+@metrics.timed("get_plot_file")
+def get_plot_file(regions, pop, render_params=None, granularity=REGION, metric=NUOVI_POSITIVI):
     """Returns the file name of the plot.
 
-    Generates the plot if needed.
+    Generates the plot if needed, and reports a render over the page budget.
 
     Args:
         regions (list): the selected regions
         pop (dict): region, population
+        render_params (dict): format and dpi of the plot, the default ones if None
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+        metric (str): a key of DATA_METRICS, the selected metric
 
     Returns:
         str: the file name for the chosen inputs
     """
 
-    filename = manage_output.get_filename_from_regions(regions)
+    filename = manage_output.get_filename_from_regions(
+        regions, render_params=render_params, granularity=granularity, metric=metric
+    )
 
-    # Only produce a plot if the file is missing
-    if not os.path.isfile(os.path.join(IMAGES, filename)):
-        manage_app.compare_regions(regions, pop, download=False)
+    # Only produce a plot if the file is missing, once for concurrent requests
+    if not image_store.lookup(filename):
+        with image_store.single_flight(filename):
+            if not image_store.exists(filename):
+                t0 = time.perf_counter()
+                manage_app.compare_regions(
+                    regions, pop, download=False, filename=filename, render_params=render_params,
+                    granularity=granularity, metric=metric
+                )
+                check_budget("plot", time.perf_counter() - t0, PAGE_BUDGET)
 
     return filename
 
 
-def generate_all_heatmaps(log_pivot_regs):
-    """Generates all the heatmap files.
+def timed_call(func, *args):
+    """Calls a function and measures its duration.
+
+    Args:
+        func (function): the function to call
+        args: its arguments
+
+    Returns:
+        (object, float): the result, seconds elapsed
+    """
+
+    t0 = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - t0
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    """Executor running each task when it is submitted, in this process."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+@metrics.timed("run_task_graph")
+def run_task_graph(graph, max_workers=NIGHTLY_WORKERS, in_process=False):
+    """Runs tasks in a process pool, each one as soon as its dependencies are done.
+
+    Functions and arguments must be picklable. A timing report is printed at the end,
+    the time of each task is added to the metrics of this process.
+
+    Args:
+        graph (dict of (str, (function, tuple, list of str))): task name: function, arguments, tasks it depends on
+        max_workers (int): processes in the pool, one per cpu if None
+        in_process (bool): True to run the tasks in this process, one at a time, e.g. to profile them
+
+    Returns:
+        (dict of (str, object), dict of (str, float)): task results, seconds spent in each task
+    """
+
+    results = {}
+    timings = {}
+    pending = dict(graph)
+    running = {}
+    t0 = time.perf_counter()
+
+    executor = InlineExecutor() if in_process else concurrent.futures.ProcessPoolExecutor(max_workers)
+    with executor as pool:
+        while pending or running:
+            ready = [name for name, (_, _, deps) in pending.items() if all(d in results for d in deps)]
+            if not ready and not running:
+                raise ValueError(f"Unsatisfiable dependencies: {sorted(pending)}")
+            for name in ready:
+                func, args, _ = pending.pop(name)
+                running[pool.submit(timed_call, func, *args)] = name
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], timings[name] = future.result()
+                metrics.observe(f"task {name}", timings[name])
+
+    for name, elapsed in sorted(timings.items(), key=lambda t: -t[1]):
+        print(f"{name:<30} {elapsed:8.2f} s")
+    print(f"{'total (wall clock)':<30} {time.perf_counter() - t0:8.2f} s")
+
+    return results, timings
+
+
+def update_distances(log_pivot_regs, granularity=REGION):
+    """Updates the stored distances between the regions, read by the sort functions.
 
     Args:
         log_pivot_regs (pandas.DataFrame) : The data
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
     """
 
-    for sort_name in manage_output.sort_functions.keys():
-        manage_output.build_heatmap(log_pivot_regs, sort_name)
-    manage_output.build_clustered_plot(log_pivot_regs)
+    for metric in ("euclidean", "spearman"):
+        distances.get_distances(log_pivot_regs, metric, granularity=granularity)
+
+
+def get_heatmap_graph(log_pivot_regs, directory=None, granularity=REGION):
+    """Returns the tasks generating all the heatmap files, the cluster plot and the default start file.
+
+    The files are independent, they are built in parallel once the distances are stored.
+    Task names have the prefix of the granularity, so that the graphs of all granularities can be merged.
+
+    Args:
+        log_pivot_regs (pandas.DataFrame) : The data
+        directory (str): directory of the nightly artifacts being built
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+
+    Returns:
+        dict of (str, (function, tuple, list of str)): the task graph, for run_task_graph
+    """
+
+    def name(task):
+        return manage_input.get_granularity_file(task, granularity)
+
+    graph = {
+        name(f"heatmap_{sort_name}"): (
+            manage_output.build_heatmap, (log_pivot_regs, sort_name, directory, granularity), [name("distances")]
+        )
+        for sort_name in manage_output.sort_functions.keys()
+    }
+    graph[name("distances")] = (update_distances, (log_pivot_regs, granularity), [])
+    graph[name("peaks_clusters")] = (
+        manage_output.build_clustered_plot, (log_pivot_regs, directory, granularity), []
+    )
+    graph[name("default_start")] = (write_default_start, (log_pivot_regs, directory, granularity), [])
+
+    return graph
+
 
-def get_heatmap_file(how):
-    """Returns the file name of the heatmap.
+@metrics.timed("get_heatmap_file")
+def get_heatmap_file(how, granularity=REGION):
+    """Returns the file name of the heatmap, in the published version of the nightly artifacts.
 
-    Launches all scheduled operations if needed
+    The heatmaps are only built by the scheduled operations, never by a request. A granularity may be missing
+    from the published version, e.g. if its population table was added after the last scheduled run.
 
     Args:
         how (list): the selected heatmap
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
 
     Returns:
-        str: the file name for the chosen heatmap
+        str: the file name for the chosen heatmap, relative to the images directory, None if it was not published
     """
 
-    filepath = f"heatmap_{how}.jpg"
+    version = image_store.get_artifacts_version()
+    if version is None:
+        return None
 
-    # Reset all if the file is missing
+    filepath = "/".join([ARTIFACTS, version, manage_output.get_heatmap_filename(how, granularity)])
     if not os.path.isfile(os.path.join(IMAGES, filepath)):
-        scheduled_reset_operations()
+        return None
 
     return filepath
@@ -1,18 +1,187 @@
 """Clusterizes the time series."""
+import json
 
 from scipy import signal
 import numpy as np
 import pandas as pd
 
 from tslearn.clustering import TimeSeriesKMeans
+from tslearn.metrics import cdist_dtw
 
+from constants import CLUSTERS_INERTIA_TOLERANCE, CLUSTERS_STATE, REGION
+import manage_input
+import metrics
 
-def get_clusters(log_pivot_regs, n_clusters=3):
+# Options of the dynamic time warping used by get_clusters
+dtw_params = {
+    "global_constraint": None,  # None, "sakoe_chiba" or "itakura"
+    "sakoe_chiba_radius": None,  # Days, for "sakoe_chiba"
+    "itakura_max_slope": None,  # For "itakura"
+    "paa_window": None,  # Days averaged together before clustering, None to keep the daily values
+}
+
+
+def get_metric_params(global_constraint=None, sakoe_chiba_radius=None, itakura_max_slope=None, paa_window=None):
+    """Returns the warping constraint of the clustering, in tslearn format.
+
+    Args:
+        global_constraint (str): None, "sakoe_chiba" or "itakura"
+        sakoe_chiba_radius (int): maximum warping, in days
+        itakura_max_slope (float): maximum slope of the Itakura parallelogram
+        paa_window (int): days in a segment of the clustered series, the radius is scaled accordingly
+
+    Returns:
+        dict: metric_params for tslearn, None if unconstrained
+    """
+
+    if global_constraint == "sakoe_chiba":
+        radius = sakoe_chiba_radius if paa_window is None else -(-sakoe_chiba_radius // paa_window)
+        return {"global_constraint": "sakoe_chiba", "sakoe_chiba_radius": radius}
+    if global_constraint == "itakura":
+        return {"global_constraint": "itakura", "itakura_max_slope": itakura_max_slope}
+    return None
+
+
+def paa(series, window):
+    """Piecewise aggregate approximation: averages consecutive days.
+
+    Segments are aligned to the last day, the oldest days that do not fill a segment are dropped.
+
+    Args:
+        series (numpy.ndarray): (n_series, n_days, 1) time series
+        window (int): days in a segment
+
+    Returns:
+        numpy.ndarray: (n_series, n_days // window, 1) averaged series
+    """
+
+    n_series, n_days, n_dims = series.shape
+    n_segments = n_days // window
+    aligned = series[:, n_days - n_segments * window:, :]
+
+    return aligned.reshape(n_series, n_segments, window, n_dims).mean(axis=2)
+
+
+def expand_paa(series, window, n_days):
+    """Brings averaged series back to one value per day.
+
+    Args:
+        series (numpy.ndarray): (n_series, n_segments) averaged series
+        window (int): days in a segment
+        n_days (int): days of the original series
+
+    Returns:
+        numpy.ndarray: (n_series, n_days) series, constant over each segment
+    """
+
+    expanded = np.repeat(series, window, axis=1)
+    head = np.repeat(expanded[:, :1], n_days - expanded.shape[1], axis=1)  # Dropped oldest days
+
+    return np.hstack([head, expanded])
+
+
+def assign_clusters(series, centers, metric_params=None):
+    """Assigns each series to the closest center by dtw.
+
+    The centers are not regions: the distances cannot be read from the region by region store of distances.py.
+
+    Args:
+        series (numpy.ndarray): (n_series, n_days, 1) time series
+        centers (numpy.ndarray): (n_clusters, n_days) cluster centers
+        metric_params (dict): warping constraint in tslearn format, None if unconstrained
+
+    Returns:
+        numpy.ndarray: cluster label of each series
+    """
+
+    dists = cdist_dtw(series, centers[:, :, np.newaxis], n_jobs=-1, **(metric_params or {}))
+
+    return dists.argmin(axis=1)
+
+
+def read_clusters_state(granularity=REGION):
+    """Reads the clustering saved by the last warm-started run.
+
+    Args:
+        granularity (str): a key of GRANULARITIES
+
+    Returns:
+        dict: centers, regions, options, inertia and full_inertia per time step, None if missing
+    """
+
+    return manage_input.read_npz(manage_input.get_granularity_file(CLUSTERS_STATE, granularity))
+
+
+def write_clusters_state(centers, labels, regions, options, inertia, full_inertia, granularity=REGION):
+    """Saves a clustering, to initialize the next one.
+
+    Args:
+        centers (numpy.ndarray): (n_clusters, n_steps) centers of the clustered series
+        labels (numpy.ndarray): cluster of each region
+        regions (list of str): clustered regions
+        options (dict): dtw options of the clustering
+        inertia (float): inertia per time step
+        full_inertia (float): inertia per time step of the last full clustering, the reference of the warm starts
+        granularity (str): a key of GRANULARITIES
+    """
+
+    state = {
+        "centers": centers,
+        "labels": labels,
+        "regions": np.array(regions, dtype=str),
+        "options": np.array(json.dumps(options, sort_keys=True)),
+        "inertia": np.array(inertia),
+        "full_inertia": np.array(full_inertia),
+    }
+    manage_input.write_npz(manage_input.get_granularity_file(CLUSTERS_STATE, granularity), state)
+
+
+def get_warm_start_centers(state, regions, options, n_clusters, n_steps):
+    """Extends the saved centers to the current length of the series.
+
+    New time steps repeat the last value of each center.
+
+    Args:
+        state (dict): the saved clustering
+        regions (list of str): regions to cluster
+        options (dict): dtw options of the clustering
+        n_clusters (int): clusters to make
+        n_steps (int): length of the clustered series
+
+    Returns:
+        numpy.ndarray: (n_clusters, n_steps, 1) initial centers, None if the saved clustering does not match
+    """
+
+    if (
+        state is None
+        or "full_inertia" not in state
+        or list(state["regions"]) != list(regions)
+        or str(state["options"]) != json.dumps(options, sort_keys=True)
+        or len(state["centers"]) != n_clusters
+    ):
+        return None
+
+    centers = state["centers"][:, :n_steps]
+    centers = np.pad(centers, ((0, 0), (0, n_steps - centers.shape[1])), mode="edge")
+
+    return centers[:, :, np.newaxis]
+
+
+@metrics.timed("get_clusters")
+def get_clusters(log_pivot_regs, n_clusters=3, random_state=42, warm_start=False, granularity=REGION, **kwargs):
     """Dynamic time warping clusterizes the regions and finds their peaks.
 
+    With warm_start, the clustering starts from the centers of the last warm-started run, with a single
+    initialization. A full clustering is made only if the inertia per time step worsens past a tolerance,
+    compared to the last full clustering: slow drifts over many warm runs are caught too.
+
     Args:
         log_pivot_regs (pandas.DataFrame): Transformed values.
         n_clusters: Region clusters to make.
+        random_state (int): seed of the cluster initializations
+        warm_start (bool): True to start from the saved clustering and save the new one
+        granularity (str): a key of GRANULARITIES, the granularity of the regions
+        kwargs: options overriding dtw_params
 
     Returns:
         pandas.DataFrame: (n_clusters, n_days) clustered trajectory.
@@ -20,17 +189,54 @@ def get_clusters(log_pivot_regs, n_clusters=3):
         list of ndarray: list of peak x coordinates
     """
 
-    # Finds the clusters
-    model = TimeSeriesKMeans(n_clusters=n_clusters, metric="dtw", n_init=10, n_jobs=-1, random_state=42)
-    model.fit_transform(log_pivot_regs.values.T[:, :, np.newaxis])
-    clust_centers = model.cluster_centers_.squeeze()
+    options = dict(dtw_params, **kwargs)
+    paa_window = options["paa_window"]
+    metric_params = get_metric_params(**options)
+    full_metric_params = get_metric_params(**dict(options, paa_window=None))  # Constraint on the daily series
+
+    series = log_pivot_regs.values.T[:, :, np.newaxis]
+    fit_series = series if paa_window is None else paa(series, paa_window)
+
+    # Finds the clusters, from the last ones if possible
+    model = None
+    state = read_clusters_state(granularity) if warm_start else None
+    init_centers = get_warm_start_centers(state, log_pivot_regs.columns, options, n_clusters, fit_series.shape[1])
+    if init_centers is not None:
+        model = TimeSeriesKMeans(
+            n_clusters=n_clusters, metric="dtw", metric_params=metric_params, init=init_centers, n_init=1, n_jobs=-1
+        )
+        model.fit(fit_series)
+        full_inertia = float(state["full_inertia"])
+        if model.inertia_ / fit_series.shape[1] > full_inertia * (1 + CLUSTERS_INERTIA_TOLERANCE):
+            model = None  # The old clusters do not fit any more
+    if model is None:
+        model = TimeSeriesKMeans(
+            n_clusters=n_clusters, metric="dtw", metric_params=metric_params, n_init=10, n_jobs=-1,
+            random_state=random_state
+        )
+        model.fit(fit_series)
+        full_inertia = model.inertia_ / fit_series.shape[1]
+    clust_centers = model.cluster_centers_.squeeze(axis=2)
+    labels = model.labels_
+
+    if warm_start:
+        write_clusters_state(
+            clust_centers, labels, log_pivot_regs.columns, options, model.inertia_ / fit_series.shape[1], full_inertia,
+            granularity
+        )
+
+    # Back to daily values: centers are expanded, regions assigned again at full resolution
+    if paa_window is not None:
+        clust_centers = expand_paa(clust_centers, paa_window, series.shape[1])
+        labels = assign_clusters(series, clust_centers, full_metric_params)
 
     # Sorts the clusters, biggest one first
     clust_centers_argsort = clust_centers.sum(axis=1).argsort()[::-1]
     clust_centers = clust_centers[clust_centers_argsort, :]
 
     # Gets the region names in each cluster
-    ordered_labels = [clust_centers_argsort[lab] for lab in model.labels_]
+    cluster_order = clust_centers_argsort.argsort()  # Position of each old cluster after sorting
+    ordered_labels = [cluster_order[lab] for lab in labels]
     cluster_labels = [[log_pivot_regs.columns[l] for l in range(len(ordered_labels)) if ordered_labels[l] == c]
                       for c in range(n_clusters)]
 
@@ -41,6 +247,3 @@ def get_clusters(log_pivot_regs, n_clusters=3):
     clust_centers = pd.DataFrame(clust_centers, columns=log_pivot_regs.index.strftime("%Y-%m-%d"))
 
     return clust_centers, cluster_labels, clust_peaks
-
-
-